@@ -0,0 +1,310 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    Benchmark kindleparse on synthetic data.
+
+    Generates a large My Clippings.txt, a multi-hundred-page PDF and a
+    dense set of highlights, then times every stage of the conversion.
+    Every benchmark runs in a child process, so that its peak memory
+    is measured on its own. Results are printed as JSON.
+
+    Usage:
+
+        # export PYTHONPATH+=:$PWD
+        # python bench/bench_kindleparse.py -o bench_output.txt
+        # python bench/bench_kindleparse.py --scale 4 --repeat 5
+
+"""
+from __future__ import unicode_literals, print_function, division
+from multiprocessing import Process, Queue
+from os.path import join as pjoin
+from Queue import Empty
+from time import time
+import argparse
+import json
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import traceback
+
+from kindleparse import clippingparser, okularwriter
+from kindleparse.clippablepdf import ClippablePDF, current_rss
+from kindleparse.store import ClippingStore
+
+WORDS = ("lock row table index query server replication transaction buffer "
+         "engine schema commit storage cache latency throughput isolation "
+         "memory disk partition cluster backup optimizer statement join").split()
+PAGE_HEIGHT, PAGE_WIDTH = 661.5, 504.0
+LINES_PER_PAGE = 40
+METADATA = ("-  La tua evidenziazione alla posizione {0}-{1} | "
+            "Aggiunto in data venerdì 7 febbraio 2014 18:12:48")
+
+
+def mk_line(rnd):
+    return " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(8, 12)))
+
+
+def mk_book(rnd, num_pages):
+    """
+    :return: a list of pages, each one a list of text lines
+    """
+    return [["%d %s" % (p, mk_line(rnd)) for _ in range(LINES_PER_PAGE)]
+            for p in range(num_pages)]
+
+
+def pdf_escape(s):
+    return s.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages, title="Benchmark Book"):
+    """
+    Write a minimal PDF with a Helvetica text line per line of the pages.
+    """
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # the page tree, once we know the page objects
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        "<< /Title (%s) >>" % pdf_escape(title),
+    ]
+    kids = []
+    for lines in pages:
+        content = "BT /F1 10 Tf 12 TL 72 %d Td " % (PAGE_HEIGHT - 72)
+        content += " ".join("(%s) Tj T*" % pdf_escape(l) for l in lines) + " ET"
+        objects.append("<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content))
+        objects.append(
+            "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %s %s] "
+            "/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>"
+            % (PAGE_WIDTH, PAGE_HEIGHT, len(objects)))
+        kids.append("%d 0 R" % len(objects))
+    objects[1] = "<< /Type /Pages /Kids [%s] /Count %d >>" % (" ".join(kids), len(kids))
+
+    out, offsets = [b"%PDF-1.4\n"], []
+    size = len(out[0])
+    for n, obj in enumerate(objects, 1):
+        offsets.append(size)
+        chunk = ("%d 0 obj\n%s\nendobj\n" % (n, obj)).encode('latin-1')
+        out.append(chunk)
+        size += len(chunk)
+    xref = "xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    xref += "".join("%010d 00000 n \n" % o for o in offsets)
+    xref += "trailer\n<< /Size %d /Root 1 0 R /Info 4 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1, size)
+    out.append(xref.encode('latin-1'))
+    with open(path, 'wb') as fh:
+        fh.write(b"".join(out))
+
+
+def pick_clippings(rnd, pages, per_page):
+    """
+    Pick per_page highlights from every page, in book order.
+    """
+    clips = []
+    for lines in pages:
+        for i in sorted(rnd.sample(range(LINES_PER_PAGE - 1), per_page)):
+            clips.append(lines[i].encode('utf-8'))
+    return clips
+
+
+def write_clippings(path, rnd, num_entries, num_books, book_clips=()):
+    """
+    Write a My Clippings.txt with num_entries random highlights
+    and the given clippings of the benchmark book.
+    """
+    titles = ["Book %d (Author %d)" % (i, i) for i in range(num_books)]
+    with open(path, 'wb') as fh:
+        def write(title, location, text):
+            fh.write(b"==========\r\n")
+            fh.write(title.encode('utf-8') + b"\r\n")
+            fh.write(METADATA.format(location, location + 1).encode('utf-8') + b"\r\n")
+            fh.write(b"\r\n" + text + b"\r\n")
+        for n in range(num_entries):
+            write(rnd.choice(titles), rnd.randint(1, 10000), mk_line(rnd).encode('utf-8'))
+        for location, text in enumerate(book_clips):
+            write("Benchmark Book (Bench Author)", location * 10, text)
+        fh.write(b"==========\r\n")
+
+
+#
+# Benchmarks: each one returns the number of items processed
+#
+def bench_parse_clippings(data):
+    return len(clippingparser.parse_clippings(data['clippings_file']))
+
+
+def bench_parse_clipping_records(data):
+    records = clippingparser.parse_clipping_records(data['clippings_file'])
+    return sum(len(clips) for clips in records.values())
+
+
+def bench_parse_clipping_store(data):
+    return ClippingStore.parse(data['clippings_file']).num_clippings
+
+
+def bench_pdf_to_text(data):
+    return len(list(ClippablePDF(data['pdf_file']).pdf_to_text()))
+
+
+def bench_search_clippings_in_text(data):
+    found = clippingparser.search_clippings_in_text(data['clips'], data['text_pages'])
+    return len(list(found))
+
+
+def setup_get_clipping_position(data):
+    pdf = ClippablePDF(data['pdf_file'])
+    pdf.load(*range(data['layout_pages']))
+    # build the index here, so that only the lookups are timed
+    pdf.layout_index
+    return dict(data, pdf=pdf)
+
+
+def bench_get_clipping_position(data):
+    pdf = data['pdf']
+    clips = data['clips'][:data['layout_pages'] * data['clips_per_page']]
+    return sum(1 for c in clips if pdf.get_clipping_position(c))
+
+
+def bench_create_xml_file(data):
+    okularwriter.create_xml_file(pjoin(data['tmpdir'], "inline.xml"), data['paged_clips'])
+    return len(data['paged_clips'])
+
+
+def bench_create_xml_file_hl(data):
+    pdf = ClippablePDF(data['pdf_file'])
+    pdf.load(*range(data['layout_pages']))
+    paged_clips = [(p + 1, c) for p, c in data['paged_clips'] if p < data['layout_pages']]
+    okularwriter.create_xml_file_hl(pjoin(data['tmpdir'], "hl.xml"), paged_clips, pdf)
+    return len(paged_clips)
+
+
+def bench_create_xml_file_hl2(data):
+    pdf = ClippablePDF(data['pdf_file'])
+    report = okularwriter.create_xml_file_hl2(
+        pjoin(data['tmpdir'], "hl2.xml"), data['clips'], pdf)
+    return len(report.found)
+
+
+# benchmark -> function preparing its data outside the timed region
+SETUP = {
+    'bench_get_clipping_position': setup_get_clipping_position,
+}
+BENCHMARKS = [
+    bench_parse_clippings,
+    bench_parse_clipping_records,
+    bench_parse_clipping_store,
+    bench_pdf_to_text,
+    bench_search_clippings_in_text,
+    bench_get_clipping_position,
+    bench_create_xml_file,
+    bench_create_xml_file_hl,
+    bench_create_xml_file_hl2,
+]
+
+
+def run_child(bench, data, queue):
+    try:
+        setup = SETUP.get(bench.__name__)
+        if setup:
+            data = setup(data)
+        rss = current_rss()
+        start = time()
+        items = bench(data)
+        seconds = time() - start
+        # the peak is in kilobytes on linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        queue.put((None, (seconds, items, max(0, peak - rss))))
+    except BaseException:
+        queue.put((traceback.format_exc(), None))
+
+
+def get_result(p, queue):
+    """
+    Wait for the result of a child process.
+    :return: a couple (error, result)
+    """
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if not p.is_alive():
+                return "exited with code %s" % p.exitcode, None
+
+
+def run(bench, data, repeat):
+    """
+    Run a benchmark repeat times, each in a new process.
+    :return: a dict with the best time and the peak memory,
+        or with the error of a failed run
+    """
+    name = bench.__name__[len("bench_"):]
+    times, peaks, items = [], [], None
+    for _ in range(repeat):
+        queue = Queue()
+        p = Process(target=run_child, args=(bench, data, queue))
+        p.start()
+        error, result = get_result(p, queue)
+        p.join()
+        if error:
+            return dict(name=name, error=error)
+        seconds, items, peak = result
+        times.append(seconds)
+        peaks.append(peak)
+    return dict(name=name, items=items,
+                best_seconds=min(times), mean_seconds=sum(times) / len(times),
+                peak_memory_bytes=max(peaks))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1].strip())
+    parser.add_argument("--scale", type=float, default=1, help="multiply the data sizes (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=42, help="random seed of the generated data")
+    parser.add_argument("-k", dest="pattern", default="", help="run only benchmarks containing this string")
+    parser.add_argument("-o", "--output", help="write results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    rnd = random.Random(args.seed)
+    num_pages = int(200 * args.scale)
+    data = dict(tmpdir=tempfile.mkdtemp(), clips_per_page=2,
+                layout_pages=min(num_pages, 20))
+    try:
+        pages = mk_book(rnd, num_pages)
+        clips = pick_clippings(rnd, pages, data['clips_per_page'])
+        data['pdf_file'] = pjoin(data['tmpdir'], b"book.pdf")
+        write_pdf(data['pdf_file'], pages)
+        data['clippings_file'] = pjoin(data['tmpdir'], b"clippings.txt")
+        write_clippings(data['clippings_file'], rnd, int(20000 * args.scale), 500, clips)
+        data['clips'] = clips
+        data['paged_clips'] = [(n // data['clips_per_page'], c) for n, c in enumerate(clips)]
+        data['text_pages'] = list(ClippablePDF(data['pdf_file']).pdf_to_text())
+
+        results = dict(
+            python=platform.python_version(), platform=platform.platform(),
+            scale=args.scale, seed=args.seed, pages=num_pages,
+            clippings=len(clips), benchmarks=[])
+        for bench in BENCHMARKS:
+            if args.pattern not in bench.__name__:
+                continue
+            result = run(bench, data, args.repeat)
+            if 'error' in result:
+                print("%(name)-28s failed: %(error)s" % result, file=sys.stderr)
+            else:
+                print("%(name)-28s %(best_seconds)8.3fs %(peak_memory_bytes)12d bytes" % result,
+                      file=sys.stderr)
+            results['benchmarks'].append(result)
+    finally:
+        shutil.rmtree(data['tmpdir'])
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        json.dump(results, out, indent=2, sort_keys=True)
+        out.write("\n")
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -12,42 +12,114 @@ from __future__ import unicode_literals, print_function
 from os.path import isfile
 import kindleparse
 import argparse
+import atexit
+import logging
+import sys
 
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ["query"]:
+        from kindleparse import query
+        raise SystemExit(query.main(sys.argv[2:]))
+
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", '--force', dest="force", default=False, action='store_const', const=True, help="overwrite existing annotation file")
+    parser.add_argument("-m", "--merge", dest="merge", default=False, action='store_const', const=True, help="add new clippings to the existing annotation file, keeping its annotations")
     parser.add_argument("-I", "--inline",  dest="inline", default=False, action='store_const', const=True, help="show clippings as inline note instead of highlight")
+    parser.add_argument("-k", "--keep-going", dest="keep_going", default=False, action='store_const', const=True, help="skip the clippings not found in the book instead of failing")
+    parser.add_argument("--cache-dir", dest="cache_dir", default=kindleparse.CACHE_HOME, help="where to cache data extracted from books (default: %(default)s)")
+    parser.add_argument("--no-cache", dest="cache_dir", action='store_const', const=None, help="don't cache data extracted from books")
+    parser.add_argument("--cache-size", dest="cache_size", default=512, type=int, help="max size in MB of the layout cache (default: %(default)s)")
+    parser.add_argument("-j", "--jobs", dest="jobs", default=1, type=int, help="number of processes extracting text from the book, or processing books with --batch (default: %(default)s)")
+    parser.add_argument("-b", "--batch", dest="batch", default=False, action='store_const', const=True, help="process many books: arguments can be pdf files, directories or files listing a pdf per line")
+    parser.add_argument("--max-memory", dest="max_memory", default=None, type=int, help="memory budget in MB used to size the batches of pages loaded at a time")
+    parser.add_argument("-w", "--watch", dest="watch", default=False, action='store_const', const=True, help="keep running and annotate the books when the clippings or the library change: arguments are like with --batch")
+    parser.add_argument("--interval", dest="interval", default=2.0, type=float, help="seconds between two checks with --watch (default: %(default)s)")
+    parser.add_argument("--no-prefilter", dest="prefilter", default=True, action='store_const', const=False, help="search the clippings in every page instead of the ones containing their text")
+    parser.add_argument("--profile", dest="profile", default=False, action='store_const', const=True, help="print the time and memory spent in each stage")
+    parser.add_argument("--profile-json", dest="profile_json", default=None, help="save the stage timings to this json file")
+    parser.add_argument("--cprofile", dest="cprofile", default=None, help="save cProfile stats to this file, see pstats")
     parser.add_argument("-c", "--clippings", dest="clip_file",
                         type=str, help="clippings file")
     parser.add_argument("pdf_file", metavar="book.pdf", type=str,
-                        nargs=1, help="PDF book to parse")
+                        nargs='+', help="PDF book to parse")
     args = parser.parse_args()
+    logging.basicConfig(format="%(message)s")
     overwrite = args.force
+    if len(args.pdf_file) > 1 and not (args.batch or args.watch):
+        parser.error("use --batch to process many books")
+
+    if args.profile or args.profile_json or args.cprofile:
+        from kindleparse import profiling
+
+        def report():
+            if args.profile:
+                print(profiling.report())
+            if args.profile_json:
+                profiling.dump_json(args.profile_json)
+            if args.cprofile:
+                profiling.dump_cprofile(args.cprofile)
+        profiling.enable(cprofile=bool(args.cprofile))
+        atexit.register(report)
 
     # Filenames are always bytes
     pdf_file = bytes(args.pdf_file[0])
     clip_file = bytes(args.clip_file)
-    # parse My Clippings.txt
-    clippings = kindleparse.parse_clippings(clip_file)
+    max_memory = args.max_memory << 20 if args.max_memory else None
+
+    if args.watch:
+        from kindleparse import watch
+        watcher = watch.LibraryWatcher(
+            clip_file, [bytes(f) for f in args.pdf_file], jobs=args.jobs,
+            cache_dir=args.cache_dir, cache_size=args.cache_size << 20,
+            max_memory=max_memory, prefilter=args.prefilter, inline=args.inline)
+        try:
+            watcher.run(args.interval)
+        except KeyboardInterrupt:
+            raise SystemExit(0)
+
+    # parse My Clippings.txt in a compact store: Clipping objects
+    # are created only for the clips of the books processed
+    clippings = kindleparse.ClippingStore.parse(clip_file)
+
+    if args.batch:
+        from kindleparse import batch
+        books = batch.find_books([bytes(f) for f in args.pdf_file])
+        summaries = batch.process_library(
+            books, clippings, jobs=args.jobs, cache_dir=args.cache_dir,
+            cache_size=args.cache_size << 20, max_memory=max_memory,
+            prefilter=args.prefilter, inline=args.inline, merge=args.merge,
+            overwrite=overwrite)
+        errors = sum(1 for s in summaries if s.error)
+        print("Processed %d books, %d errors" % (len(summaries), errors))
+        raise SystemExit(1 if errors else 0)
 
     # generate the xml file
     destfile = kindleparse.mk_destfile(pdf_file)
-    if isfile(destfile) and not overwrite:
-        raise ValueError("File %r already exists: backup your existing copy and rerun with -f to overwrite!" % destfile)
-
-    pdf = kindleparse.ClippablePDF(pdf_file)
-    if args.inline:
-        # search the clippings in your pdf
-        paged_clippings = pdf.search_clippings_in_book(clippings)
-        print("Creating file: ", destfile)
-        kindleparse.okularwriter.create_xml_file(destfile, paged_clippings)
-    else:
-        book_title = pdf.get_title()
-        assert book_title, "Missing book title"
-        amazon_title, book_clippings = kindleparse.find_clippings(
-            book_title, clippings)
-
-        print("Creating file: ", destfile)
-        kindleparse.okularwriter.create_xml_file_hl2(
-            destfile, book_clippings, pdf)
+    if isfile(destfile) and not (overwrite or args.merge):
+        raise ValueError("File %r already exists: backup your existing copy and rerun with -f to overwrite or -m to merge!" % destfile)
+
+    with kindleparse.ClippablePDF(pdf_file, cache_dir=args.cache_dir,
+                                  cache_size=args.cache_size << 20,
+                                  jobs=args.jobs) as pdf:
+        if args.inline:
+            # search the clippings in your pdf
+            paged_clippings = pdf.search_clippings_in_book(
+                clippings, strict=not args.keep_going)
+            print("Placed %d clippings" % len(paged_clippings))
+            print("Creating file: ", destfile)
+            kindleparse.okularwriter.create_xml_file(destfile, paged_clippings,
+                                                     merge=args.merge)
+        else:
+            book_title = pdf.get_title()
+            assert book_title, "Missing book title"
+            amazon_title, book_clippings = kindleparse.find_clippings(
+                book_title, clippings)
+            if not amazon_title:
+                raise ValueError("Clippings not found for %r" % book_title)
+
+            print("Creating file: ", destfile)
+            report = kindleparse.okularwriter.create_xml_file_hl2(
+                destfile, book_clippings, pdf, max_memory=max_memory,
+                prefilter=args.prefilter, merge=args.merge)
+            print("Placed %d clippings, %d not found" % (len(report.found), len(report.missed)))
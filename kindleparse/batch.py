@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    Annotate a whole PDF library against one clippings file.
+
+    Clippings are parsed and indexed once, then books are processed
+    by a pool of worker processes.
+
+    Uses clippingparser, clippablepdf and okularwriter
+"""
+from __future__ import unicode_literals, print_function
+from collections import namedtuple, OrderedDict
+from multiprocessing import Pool
+from os import walk
+from os.path import dirname, isdir, isfile, join as pjoin, realpath
+from time import time
+import clippingparser
+import clippablepdf
+import okularwriter
+import cache
+
+BookSummary = namedtuple(
+    'BookSummary', 'pdf_file title placed missed seconds error')
+
+# the state shared by the worker processes, see init_worker
+_context = {}
+
+
+def find_books(paths):
+    """
+    Expand a list of paths to pdf files.
+    :param paths: pdf files, directories searched recursively for
+        pdf files, or manifests listing a pdf file per line
+    :return: a list of pdf files
+    """
+    books = []
+    for path in paths:
+        if isdir(path):
+            for root, dirs, files in walk(path):
+                dirs.sort()
+                books.extend(pjoin(root, f) for f in sorted(files)
+                             if f.lower().endswith(b".pdf"))
+        elif path.lower().endswith(b".pdf"):
+            books.append(path)
+        else:
+            with open(path, 'rb') as fh:
+                for line in fh:
+                    line = line.strip()
+                    if line and not line.startswith(b"#"):
+                        books.append(pjoin(dirname(path), line))
+    return books
+
+
+def init_worker(context):
+    _context.update(context)
+
+
+def process_book(pdf_file):
+    """
+    Annotate a book with its clippings. Uses the context set by init_worker.
+    :param pdf_file: the pdf file
+    :return: a BookSummary
+    """
+    start = time()
+    title, placed, missed, error = None, 0, 0, None
+    try:
+        with clippablepdf.ClippablePDF(pdf_file, cache_dir=_context['cache_dir'],
+                                       cache_size=_context['cache_size']) as pdf:
+            book_title = pdf.get_title()
+            if not book_title:
+                raise ValueError("Missing book title")
+            title, book_clippings = _context['index'].find(book_title)
+            if not title:
+                raise ValueError("Clippings not found for %r" % book_title)
+            destfile = okularwriter.mk_destfile(pdf_file)
+            if isfile(destfile) and not (_context['overwrite'] or _context['merge']):
+                raise ValueError("File %r already exists" % destfile)
+            if _context['inline']:
+                report = clippingparser.match_clippings_in_text(
+                    book_clippings, pdf.text_pages())
+                okularwriter.create_xml_file(destfile, report.found, merge=_context['merge'])
+            else:
+                report = okularwriter.create_xml_file_hl2(
+                    destfile, book_clippings, pdf, max_memory=_context['max_memory'],
+                    prefilter=_context['prefilter'], merge=_context['merge'])
+            placed, missed = len(report.found), len(report.missed)
+    except Exception as e:
+        error = "%s: %s" % (e.__class__.__name__, e)
+    return BookSummary(pdf_file, title, placed, missed, time() - start, error)
+
+
+def format_summary(summary):
+    s = "%s: placed=%d missed=%d time=%.1fs" % (
+        summary.pdf_file, summary.placed, summary.missed, summary.seconds)
+    if summary.error:
+        s += " error=%s" % summary.error
+    return s
+
+
+def process_library(pdf_files, clippings, jobs=1, cache_dir=None,
+                    cache_size=None, max_memory=None, prefilter=True,
+                    inline=False, merge=False, overwrite=False, index=None):
+    """
+    Annotate many books, printing a summary line for each one.
+    :param pdf_files: a list of pdf files, see find_books
+    :param clippings: the parsed clippings, see parse_clipping_records
+    :param jobs: the number of books processed at the same time
+    :param inline: show clippings as inline notes instead of highlights
+    :param merge: merge into the existing annotation files
+    :param overwrite: overwrite the existing annotation files
+    :param index: a TitleIndex of clippings, built if missing
+    The other parameters are the ones of ClippablePDF and create_xml_file_hl2.
+    :return: a list of BookSummary, in the same order of pdf_files.
+        A book listed many times, eg. in a directory and a manifest,
+        is processed once, so workers never write the same file.
+    """
+    unique = OrderedDict()
+    for pdf_file in pdf_files:
+        unique.setdefault(realpath(pdf_file), pdf_file)
+    pdf_files = unique.values()
+    context = dict(index=index or clippingparser.TitleIndex(clippings),
+                   cache_dir=cache_dir, max_memory=max_memory,
+                   cache_size=cache_size or cache.LAYOUT_CACHE_SIZE,
+                   prefilter=prefilter, inline=inline, merge=merge,
+                   overwrite=overwrite)
+    summaries = {}
+    if jobs > 1:
+        pool = Pool(jobs, initializer=init_worker, initargs=(context,))
+        results = pool.imap_unordered(process_book, pdf_files)
+    else:
+        pool = None
+        init_worker(context)
+        results = (process_book(f) for f in pdf_files)
+    try:
+        for summary in results:
+            print(format_summary(summary))
+            summaries[summary.pdf_file] = summary
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+    return [summaries[f] for f in pdf_files]
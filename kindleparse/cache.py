@@ -0,0 +1,288 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    Persistent caches for the data extracted from PDF books.
+
+    Entries are keyed by the digest of the PDF content, so renaming or
+    touching a book doesn't invalidate them, while modifying it does.
+    Caches are stored in CACHE_HOME, next to the okular docdata.
+"""
+from __future__ import unicode_literals, print_function
+from copy import deepcopy
+from os import listdir, makedirs, rename, stat, unlink, utime
+from os.path import abspath, expanduser, isdir, isfile, join as pjoin
+import gzip
+import hashlib
+import sqlite3
+import sys
+import zlib
+
+CACHE_HOME = "~/.kde/share/apps/okular/kindleparse"
+BLOCK_SIZE = 1 << 20
+LAYOUT_CACHE_SIZE = 512 << 20
+# the page_range_key of PDFQuery.load(None), which loads no pages
+NO_PAGES = "None"
+PAGES_PER_COMMIT = 50
+# seconds to wait for other processes writing to the cache
+DB_TIMEOUT = 60
+
+
+def file_digest(path):
+    """
+    Return the sha1 hex digest of a file content
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def mk_cache_dir(cache_dir):
+    cache_dir = expanduser(cache_dir)
+    if not isdir(cache_dir):
+        makedirs(cache_dir)
+    return cache_dir
+
+
+class LazyPages(object):
+    """
+    A read-only sequence of cached text pages. Pages are loaded from the
+    database only when accessed.
+    """
+
+    def __init__(self, db, digest, start, stop):
+        self.db = db
+        self.digest = digest
+        self.start, self.stop = start, stop
+
+    def __len__(self):
+        return max(0, self.stop - self.start)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in xrange(start, stop, step)]
+            return LazyPages(self.db, self.digest,
+                             self.start + start, self.start + max(start, stop))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        row = self.db.execute(
+            "SELECT text FROM pages WHERE digest=? AND page_index=?",
+            (self.digest, self.start + i)).fetchone()
+        return zlib.decompress(bytes(row[0]))
+
+    def __iter__(self):
+        rows = self.db.execute(
+            "SELECT text FROM pages WHERE digest=? AND page_index>=? AND page_index<?"
+            " ORDER BY page_index", (self.digest, self.start, self.stop))
+        for text, in rows:
+            yield zlib.decompress(bytes(text))
+
+
+class PageTextCache(object):
+    """
+    Store the text of every pdf page in a sqlite database.
+    """
+    filename = "pagetext.sqlite"
+
+    def __init__(self, cache_dir=CACHE_HOME):
+        self.cache_dir = mk_cache_dir(cache_dir)
+        self.db = sqlite3.connect(pjoin(self.cache_dir, self.filename),
+                                  timeout=DB_TIMEOUT)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                path TEXT PRIMARY KEY, size INTEGER, mtime REAL, digest TEXT);
+            CREATE TABLE IF NOT EXISTS books (
+                digest TEXT PRIMARY KEY, num_pages INTEGER);
+            CREATE TABLE IF NOT EXISTS pages (
+                digest TEXT, page_index INTEGER, text BLOB,
+                PRIMARY KEY (digest, page_index));
+        """)
+
+    def digest(self, path):
+        """
+        Return the digest of a file, hashing it only when its size
+        or mtime changed since the last call.
+        """
+        path = abspath(path)
+        if not isinstance(path, unicode):
+            path = path.decode(sys.getfilesystemencoding(), 'replace')
+        st = stat(path)
+        row = self.db.execute(
+            "SELECT digest FROM documents WHERE path=? AND size=? AND mtime=?",
+            (path, st.st_size, st.st_mtime)).fetchone()
+        if row:
+            return row[0]
+        digest = file_digest(path)
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)",
+                (path, st.st_size, st.st_mtime, digest))
+        return digest
+
+    def get_pages(self, path):
+        """
+        :param path: the pdf file
+        :return: a LazyPages, or None if the book is not cached
+        """
+        digest = self.digest(path)
+        row = self.db.execute(
+            "SELECT num_pages FROM books WHERE digest=?", (digest,)).fetchone()
+        if row:
+            return LazyPages(self.db, digest, 0, row[0])
+
+    def put_pages(self, path, text_pages):
+        """
+        Store the text pages of a book.
+        :param path: the pdf file
+        :param text_pages: an iterable of page contents
+        :return: a LazyPages
+        """
+        digest = self.digest(path)
+        with self.db:
+            self.db.execute("DELETE FROM pages WHERE digest=?", (digest,))
+        # Commit every few pages, so that other processes
+        # don't wait for the whole book to be extracted.
+        rows, n = [], -1
+        for n, text in enumerate(text_pages):
+            rows.append((digest, n, buffer(zlib.compress(text))))
+            if len(rows) == PAGES_PER_COMMIT:
+                self._insert_pages(rows)
+        self._insert_pages(rows)
+        num_pages = n + 1
+        with self.db:
+            # mark the book as complete
+            self.db.execute(
+                "INSERT OR REPLACE INTO books VALUES (?, ?)", (digest, num_pages))
+        return LazyPages(self.db, digest, 0, num_pages)
+
+    def _insert_pages(self, rows):
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?)", rows)
+        del rows[:]
+
+
+def page_range_pages(page_range_key):
+    """
+    Parse a pdfquery page_range_key, eg. '0_1_18' -> [0, 1, 18]
+    :return: a list of page indexes, empty for all the pages
+    """
+    if not page_range_key or page_range_key == NO_PAGES:
+        return []
+    return [int(x) for x in page_range_key.split("_")]
+
+
+class LayoutTreeCache(object):
+    """
+    A parse_tree_cacher for pdfquery.PDFQuery, storing the layout
+    tree of every page in a gzipped xml file, so that the trees of
+    any page range are assembled from the pages already parsed.
+
+    When the cache grows over max_size bytes, the least recently
+    used files are removed.
+    """
+    subdir = "layout"
+    page_tag = "LTPage"
+
+    def __init__(self, cache_dir=CACHE_HOME, max_size=LAYOUT_CACHE_SIZE, digest=None):
+        """
+        :param cache_dir: the cache directory
+        :param max_size: max size of the cache in bytes
+        :param digest: a function returning the digest of a file path,
+            eg. PageTextCache.digest. Defaults to file_digest.
+        """
+        self.directory = mk_cache_dir(pjoin(cache_dir, self.subdir))
+        self.max_size = max_size
+        self.digest = digest or file_digest
+        self.hash_key = None
+
+    def set_hash_key(self, file):
+        """
+        Set the key of the pdf file used by the next calls.
+        :param file: the file object of the pdf
+        """
+        self.hash_key = self.digest(file.name)
+
+    def get_cache_path(self, page_index):
+        return pjoin(self.directory, "{hash_key}_{page}.xml.gz".format(
+            hash_key=self.hash_key, page=page_index))
+
+    def missing(self, page_indexes):
+        """
+        :return: the pages of page_indexes that are not cached
+        """
+        return [n for n in page_indexes if not isfile(self.get_cache_path(n))]
+
+    def get(self, page_range_key):
+        """
+        :return: the tree for a page range, or None when a page
+            is not cached
+        """
+        from lxml import etree
+        pages = page_range_pages(page_range_key)
+        if not pages:
+            return None
+        trees = []
+        for n in pages:
+            path = self.get_cache_path(n)
+            try:
+                with gzip.open(path, 'rb') as fh:
+                    trees.append(etree.parse(fh))
+            except (IOError, etree.XMLSyntaxError):
+                return None
+            # mark as recently used
+            utime(path, None)
+        root = trees[0].getroot()
+        for tree in trees[1:]:
+            root.extend(tree.getroot().iterchildren(self.page_tag))
+        return trees[0]
+
+    def set(self, page_range_key, tree):
+        """
+        Store the tree of every page of a page range and evict old entries.
+        """
+        from lxml import etree
+        if page_range_key == NO_PAGES:
+            return
+        root = tree.getroot()
+        paths = set()
+        for page in root.iterchildren(self.page_tag):
+            page_root = etree.Element(root.tag, dict(root.attrib))
+            page_root.append(deepcopy(page))
+            path = self.get_cache_path(page.get('page_index'))
+            tmp = path + ".tmp"
+            with gzip.open(tmp, 'wb') as fh:
+                fh.write(etree.tostring(page_root, encoding='utf-8', xml_declaration=True))
+            rename(tmp, path)
+            paths.add(path)
+        self.evict(keep=paths)
+
+    def evict(self, keep=()):
+        """
+        Remove the least recently used files until the cache
+        size is below max_size.
+        :param keep: the file paths not to remove
+        """
+        entries = []
+        for name in listdir(self.directory):
+            try:
+                st = stat(pjoin(self.directory, name))
+            except OSError:
+                # removed by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        size = sum(e[1] for e in entries)
+        for _, file_size, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            if pjoin(self.directory, name) in keep:
+                continue
+            try:
+                unlink(pjoin(self.directory, name))
+            except OSError:
+                pass
+            size -= file_size
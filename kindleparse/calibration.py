@@ -0,0 +1,238 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    Predict the pages of a clip from its Kindle location.
+
+    Kindle locations grow with the text, so they map to pdf pages through
+    a monotone function. LocationModel fits it with a piecewise-linear
+    interpolation of the clips placed so far, and predicts a few pages
+    where to search each remaining clip.
+
+    Models are saved per book in the cache directory, so that later
+    runs start with a calibrated model.
+
+    Uses clippingparser and matcher
+"""
+from __future__ import unicode_literals, print_function, division
+from bisect import bisect_left, insort
+from math import ceil
+from os import rename
+from os.path import join as pjoin
+import json
+import clippingparser
+import matcher
+import cache
+
+# the model predicts pages once it has this many points
+MIN_POINTS = 2
+# pages searched before and after the predicted one
+MARGIN = 2
+# the fraction of the pages between the nearest points
+# added to the margin, as the error grows far from them
+UNCERTAINTY = 0.25
+# clips searched in the whole book to calibrate a new model
+SAMPLE_SIZE = 8
+
+
+def location(clip):
+    """
+    Return the Kindle location of a clip, or None for plain strings.
+    """
+    return getattr(clip, 'start', None)
+
+
+class LocationModel(object):
+    """
+    A monotone map from Kindle locations to page indexes.
+    """
+
+    def __init__(self, num_pages, points=()):
+        """
+        :param num_pages: the number of pages of the book
+        :param points: a list of (location, page_index)
+        """
+        self.num_pages = num_pages
+        self.points = []
+        self._knots = None
+        for loc, page in points:
+            self.add(loc, page)
+
+    def add(self, loc, page):
+        """
+        Learn that the location loc is in page.
+        """
+        if loc is None or (loc, page) in self.points:
+            return
+        insort(self.points, (loc, page))
+        self._knots = None
+
+    @property
+    def knots(self):
+        """
+        The points of the fit: the longest subsequence of points where
+        pages don't decrease, so that a few wrong matches are ignored.
+        """
+        if self._knots is None:
+            chosen = clippingparser.longest_page_sequence(
+                [[page] for _, page in self.points])
+            knots = []
+            for i in sorted(chosen):
+                loc, page = self.points[i]
+                # keep the first page of every location
+                if not knots or knots[-1][0] != loc:
+                    knots.append((loc, page))
+            self._knots = knots
+        return self._knots
+
+    def ready(self):
+        return len(self.knots) >= MIN_POINTS
+
+    def predict(self, loc):
+        """
+        :return: a couple (page, uncertainty) where page is a float and
+            uncertainty is the number of pages between the nearest
+            points, or None if the model is not ready
+        """
+        if loc is None or not self.ready():
+            return None
+        knots = self.knots
+        k = bisect_left(knots, (loc, ))
+        if 0 < k < len(knots):
+            (l0, p0), (l1, p1) = knots[k - 1], knots[k]
+            return p0 + (p1 - p0) * (loc - l0) / (l1 - l0), p1 - p0
+        # outside the known locations, extrapolate with the mean slope
+        (l0, p0), (l1, p1) = knots[0], knots[-1]
+        slope = (p1 - p0) / (l1 - l0)
+        lk, pk = knots[0] if k == 0 else knots[-1]
+        page = pk + slope * (loc - lk)
+        return page, abs(page - pk)
+
+    def window(self, loc):
+        """
+        :return: the sorted page indexes where to search a location,
+            or None if the model is not ready
+        """
+        prediction = self.predict(loc)
+        if prediction is None:
+            return None
+        page, uncertainty = prediction
+        margin = MARGIN + int(ceil(uncertainty * UNCERTAINTY))
+        first = max(0, int(page) - margin)
+        last = min(self.num_pages - 1, int(ceil(page)) + margin)
+        return range(first, last + 1)
+
+    def to_dict(self):
+        return dict(num_pages=self.num_pages, points=self.points)
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['num_pages'], [tuple(p) for p in d['points']])
+
+
+class ModelStore(object):
+    """
+    Save a LocationModel per book in a json file.
+    """
+    subdir = "calibration"
+
+    def __init__(self, cache_dir=cache.CACHE_HOME, digest=None):
+        """
+        :param digest: a function returning the digest of a file path,
+            eg. PageTextCache.digest. Defaults to file_digest.
+        """
+        self.directory = cache.mk_cache_dir(pjoin(cache_dir, self.subdir))
+        self.digest = digest or cache.file_digest
+
+    def path(self, book_file):
+        return pjoin(self.directory, "%s.json" % self.digest(book_file))
+
+    def load(self, book_file, num_pages):
+        """
+        :return: the saved model of a book, or a new one
+        """
+        try:
+            with open(self.path(book_file)) as fh:
+                return LocationModel.from_dict(json.load(fh))
+        except (IOError, ValueError, KeyError, TypeError):
+            return LocationModel(num_pages)
+
+    def save(self, book_file, model):
+        path = self.path(book_file)
+        tmp = path + ".tmp"
+        with open(tmp, 'w') as fh:
+            json.dump(model.to_dict(), fh)
+        rename(tmp, path)
+
+
+def sample(clippings, size=SAMPLE_SIZE):
+    """
+    Return the indexes of up to size clips with a location,
+    evenly spaced in the list.
+    """
+    located = [n for n, c in enumerate(clippings) if location(c) is not None]
+    if len(located) <= size:
+        return located
+    step = (len(located) - 1) / (size - 1)
+    return sorted(set(located[int(round(i * step))] for i in range(size)))
+
+
+def scan_clippings(clippings, text_pages, model):
+    """
+    Like PageMatcher.scan, but search each clip only in the pages
+    predicted by the model. Clips not found there, or without a
+    location, are searched in the whole book.
+
+    A new model is calibrated with a sample of clips during a single
+    scan of all the clips, whose hits are then narrowed to the pages
+    predicted. Every clip found in a single page is added to the model.
+    :param clippings: a list of clippings
+    :param text_pages: a sequence of page contents
+    :param model: a LocationModel
+    :return: a list with the sorted page indexes of every clip
+    """
+    hits = [None] * len(clippings)
+
+    def learn(n):
+        if len(hits[n]) == 1:
+            model.add(location(clippings[n]), hits[n][0])
+
+    def scan(indexes):
+        found = matcher.PageMatcher([clippings[n] for n in indexes]).scan(text_pages)
+        for n, pages_found in zip(indexes, found):
+            hits[n] = pages_found
+            learn(n)
+
+    if not model.ready():
+        # the whole book is read anyway: search all the clips at once,
+        # calibrate with a sample of them, then keep the hits of the
+        # other ones in the pages predicted, if any
+        found = matcher.PageMatcher(clippings).scan(text_pages)
+        for n in sample(clippings):
+            hits[n] = found[n]
+            learn(n)
+        for n, clip in enumerate(clippings):
+            if hits[n] is None:
+                window = model.window(location(clip)) or ()
+                hits[n] = [p for p in found[n] if p in window] or found[n]
+                learn(n)
+        return hits
+    # search every clip in its window with a single scan of their pages
+    windows = {}
+    for n, clip in enumerate(clippings):
+        window = None if hits[n] is not None else model.window(location(clip))
+        if window:
+            windows[n] = set(window)
+    if windows:
+        indexes = sorted(windows)
+        pages = sorted(p for p in set().union(*windows.values())
+                       if p < len(text_pages))
+        found = matcher.PageMatcher([clippings[n] for n in indexes]).scan(text_pages, pages)
+        for n, pages_found in zip(indexes, found):
+            pages_found = [p for p in pages_found if p in windows[n]]
+            if pages_found:
+                hits[n] = pages_found
+                model.add(location(clippings[n]), pages_found[0])
+    rest = [n for n, h in enumerate(hits) if h is None]
+    if rest:
+        scan(rest)
+    return hits
@@ -5,49 +5,226 @@
 
     Code inspired by pdf2txt.py
 
+    pdfminer and pdfquery are slow to import, so they are imported
+    only when a pdf is actually parsed: importing this module is cheap.
+
+    The pdf file is memory mapped and parsed once: page count, metadata,
+    text extraction and layout share the PDFDocument of pdfquery.
+
     Uses clippingparser
 """
+from __future__ import division
 
-from pdfminer.layout import LTTextLineHorizontal
-from pdfminer.pdfdocument import PDFDocument
-from pdfminer.pdfparser import PDFParser
-from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
-from pdfminer.pdfdevice import PDFDevice
-from pdfminer.pdfpage import PDFPage
-from pdfminer.converter import TextConverter
-from pdfminer.cmapdb import CMapDB
-from pdfminer.layout import LAParams
 from StringIO import StringIO
-from pyPdf import PdfFileReader
-import pdfquery
-import re
+import gc
+import mmap
 import clippingparser
-from pdfquery.cache import FileCache
+import cache
+import calibration
+import layoutindex
+import matcher
+import profiling
+from profiling import current_rss
 CODEC = 'utf-8'
-PDF_PAGE_FIELDS = "page_index height width".split(
-    )  # get those fields from PDF
-re_parens = re.compile(r"[()]")
+PAGE_CHUNKS_PER_JOB = 4
+# pages loaded at a time by load_batches
+BATCH_SIZE = 20
+FIRST_BATCH_SIZE = 4
+MAX_BATCH_SIZE = 200
 
 caching = True
 debug = False
-PDFDocument.debug = debug
-PDFParser.debug = debug
-CMapDB.debug = debug
-PDFResourceManager.debug = debug
-PDFPageInterpreter.debug = debug
-PDFDevice.debug = debug
+
+
+def import_pdfminer():
+    """
+    Import pdfminer and set its debug flags.
+    """
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdfparser import PDFParser
+    from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+    from pdfminer.pdfdevice import PDFDevice
+    from pdfminer.cmapdb import CMapDB
+    for cls in (PDFDocument, PDFParser, CMapDB, PDFResourceManager,
+                PDFPageInterpreter, PDFDevice):
+        cls.debug = debug
+
+
+class MappedFile(object):
+    """
+    A read-only file object backed by a memory map, so that
+    the parser seeks and reads without system calls.
+    """
+
+    def __init__(self, path):
+        self.name = path
+        with open(path, 'rb') as fh:
+            self.map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        # the parser only uses these methods
+        self.read, self.seek, self.tell = self.map.read, self.map.seek, self.map.tell
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_pdf(path):
+    """
+    Open a pdf file for parsing, memory mapping it when possible.
+    :return: a file object
+    """
+    try:
+        return MappedFile(path)
+    except (ValueError, EnvironmentError):
+        # eg. empty files can't be mapped
+        return open(path, 'rb')
+
+
+def open_document(fp):
+    """
+    Parse the xref and the trailer of a pdf.
+    :param fp: a file object, see open_pdf
+    :return: a PDFDocument
+    """
+    import_pdfminer()
+    from pdfminer.pdfparser import PDFParser
+    from pdfminer.pdfdocument import PDFDocument
+    parser = PDFParser(fp)
+    doc = PDFDocument(parser, caching=caching)
+    parser.set_document(doc)
+    return doc
+
+
+def count_pages(doc):
+    """
+    Return the number of pages of a PDFDocument, reading the page
+    tree Count when present instead of walking the page tree.
+    """
+    from pdfminer.pdftypes import resolve1
+    from pdfminer.pdfpage import PDFPage
+    pages = resolve1(doc.catalog.get('Pages'))
+    count = resolve1(pages.get('Count')) if isinstance(pages, dict) else None
+    if isinstance(count, int):
+        return count
+    return sum(1 for _ in PDFPage.create_pages(doc))
+
+
+def iter_page_text(book_file, pagenos=None, maxpages=0, document=None):
+    """
+    Return a generator with the text of the pages of a pdf file.
+
+    :param book_file: the pdf file
+    :param pagenos: a set of page indexes to convert, default all
+    :param maxpages: limit the pages to convert
+    :param document: the PDFDocument of book_file, if already parsed
+    :return: a generator with the text content of the pages
+    """
+    import_pdfminer()
+    from pdfminer.pdfinterp import PDFResourceManager, PDFPageInterpreter
+    from pdfminer.pdfpage import PDFPage, PDFTextExtractionNotAllowed
+    from pdfminer.converter import TextConverter
+    from pdfminer.layout import LAParams
+    outfp = StringIO()
+    imagewriter = None
+    laparams = LAParams()
+
+    rsrcmgr = PDFResourceManager(caching=caching)
+    fp = None
+    if document is None:
+        fp = open_pdf(book_file)
+        document = open_document(fp)
+    try:
+        if not document.is_extractable:
+            raise PDFTextExtractionNotAllowed(
+                'Text extraction is not allowed: %r' % book_file)
+        # Create a TextConverter device writing out to our buffer
+        device = TextConverter(
+            rsrcmgr, outfp, codec=CODEC, laparams=laparams,
+                               imagewriter=imagewriter)
+        interpreter = PDFPageInterpreter(rsrcmgr, device)
+        # Retrieve only the matching pages, and stop after the last one
+        last = max(pagenos) if pagenos else None
+        for pageno, p in enumerate(PDFPage.create_pages(document)):
+            if maxpages and pageno >= maxpages:
+                break
+            if pagenos and pageno not in pagenos:
+                continue
+            with profiling.stage("pdf_to_text"):
+                interpreter.process_page(p)
+            profiling.count("pages_extracted")
+            yield outfp.getvalue()
+            outfp.truncate(0)
+            if pageno == last:
+                break
+    finally:
+        if fp is not None:
+            fp.close()
+
+
+def _page_text_worker(args):
+    book_file, pagenos = args
+    return list(iter_page_text(book_file, pagenos=set(pagenos)))
+
+
+def parallel_page_text(book_file, num_pages, jobs):
+    """
+    Like iter_page_text, but split the pages between worker processes.
+    Every worker parses the pdf on its own.
+
+    :param book_file: the pdf file
+    :param num_pages: the number of pages to convert
+    :param jobs: the number of worker processes
+    :return: a generator with the text content of the pages, in order
+    """
+    # Use more chunks than workers, as page density varies
+    chunk = max(1, -(-num_pages // (jobs * PAGE_CHUNKS_PER_JOB)))
+    tasks = [(book_file, range(i, min(i + chunk, num_pages)))
+             for i in xrange(0, num_pages, chunk)]
+    from multiprocessing import Pool
+    pool = Pool(min(jobs, len(tasks)) or 1)
+    try:
+        for texts in pool.imap(_page_text_worker, tasks):
+            for text in texts:
+                yield text
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 class ClippablePDF():
-    def __init__(self, book_file):
+    def __init__(self, book_file, cache_dir=None, cache_size=cache.LAYOUT_CACHE_SIZE,
+                 jobs=1):
+        """
+        :param book_file: the pdf file
+        :param cache_dir: where to cache data extracted from the pdf,
+            eg. cache.CACHE_HOME. If None, don't cache.
+        :param cache_size: max size in bytes of the layout tree cache
+        :param jobs: the number of processes extracting text
+        """
+        import_pdfminer()
+        import pdfquery
         self.book_file = book_file
-        self.pdf_query = pdfquery.PDFQuery(book_file
-                                           #                                   , parse_tree_cacher=FileCache("/tmp/")
-                                           )
+        self.jobs = jobs
+        self.text_cache = self.layout_cache = self.model_store = None
+        if cache_dir:
+            self.text_cache = cache.PageTextCache(cache_dir)
+            self.layout_cache = cache.LayoutTreeCache(
+                cache_dir, cache_size, digest=self.text_cache.digest)
+            self.model_store = calibration.ModelStore(
+                cache_dir, digest=self.text_cache.digest)
+        # pdfquery parses the file, then everybody uses its document
+        self.pdf_query = pdfquery.PDFQuery(open_pdf(book_file),
+                                           parse_tree_cacher=self.layout_cache)
+        self.document = self.pdf_query.doc
+        self._layout_index = self._layout_index_tree = None
         self.pdf_query.load(None)
-        with open(book_file, 'rb') as fh:
-            pdf = PdfFileReader(fh)
-            self.num_pages = pdf.getNumPages()
+        self.num_pages = count_pages(self.document)
 
     def get_title(self):
         """
@@ -55,87 +232,212 @@ class ClippablePDF():
         :param book_file:
         :return:
         """
-        return self.pdf_query.doc.info[0].get('Title')
+        return self.document.info[0].get('Title')
 
-    def pdf_to_text(self, maxpages=0):
+    def pdf_to_text(self, maxpages=0, jobs=None):
         """
         Return a generator list of text pages of a given file.
 
         :param book_file:
         :param maxpage: limit the pages to convert
+        :param jobs: the number of worker processes, default to self.jobs
         :return: a generator with the text content of the pages
         """
-        outfp = StringIO()
-        imagewriter = None
-        laparams = LAParams()
-
-        rsrcmgr = PDFResourceManager(caching=caching)
-        with file(self.book_file, 'rb') as fp:
-            # Create a TextConverter device writing out to our buffer
-            device = TextConverter(
-                rsrcmgr, outfp, codec=CODEC, laparams=laparams,
-                                   imagewriter=imagewriter)
-            interpreter = PDFPageInterpreter(rsrcmgr, device)
-            # Parse the pdf file, retrieving only the matching pages
-            pages = PDFPage.get_pages(fp, maxpages=maxpages,
-                                      caching=caching,
-                                      check_extractable=True)
-            for p in pages:
-                interpreter.process_page(p)
-                yield outfp.getvalue()
-                outfp.truncate(0)
+        jobs = jobs or self.jobs
+        if jobs <= 1:
+            return iter_page_text(self.book_file, maxpages=maxpages,
+                                  document=self.document)
+        num_pages = min(maxpages, self.num_pages) if maxpages else self.num_pages
+        return parallel_page_text(self.book_file, num_pages, jobs)
+
+    def text_pages(self):
+        """
+        Return the text pages of the book. When caching is enabled,
+        the pdf is interpreted only the first time and pages are
+        loaded one at a time.
+        :return: a sequence with the text content of the pages
+        """
+        if not self.text_cache:
+            return list(self.pdf_to_text())
+        with profiling.stage("text_cache"):
+            pages = self.text_cache.get_pages(self.book_file)
+        if pages is None:
+            profiling.count("text_cache_misses")
+            pages = self.text_cache.put_pages(self.book_file, self.pdf_to_text())
+        return pages
+
+    def location_model(self):
+        """
+        Return the calibration.LocationModel of the book: the saved
+        one when caching is enabled, otherwise a new one.
+        """
+        if not self.model_store:
+            return calibration.LocationModel(self.num_pages)
+        return self.model_store.load(self.book_file, self.num_pages)
+
+    def save_location_model(self, model):
+        if self.model_store:
+            self.model_store.save(self.book_file, model)
+
+    def candidate_pages(self, clippings):
+        """
+        Find the pages that may contain the clippings using the page
+        text, which is much cheaper than the layout tree.
+        :param clippings: a list of clippings
+        :return: a couple (pages, unmatched) of the sorted indexes of the
+            pages containing a clip or following one, as a clip may
+            continue there, and the clippings not in any page
+        """
+        text_pages = self.text_pages()
+        with profiling.stage("prefilter"):
+            hits = matcher.PageMatcher(clippings).scan(text_pages)
+        pages = sorted(set(q for page_hits in hits for p in page_hits
+                           for q in (p, p + 1) if q < self.num_pages))
+        unmatched = [c for c, page_hits in zip(clippings, hits) if not page_hits]
+        return pages, unmatched
+
+    def load(self, *page_numbers):
+        """
+        Load the layout tree of the given pages, see PDFQuery.load.
+        When caching is enabled, only the pages not in the cache
+        are parsed.
+        """
+        with profiling.stage("load_layout"):
+            if self.layout_cache:
+                page_numbers = page_numbers or range(self.num_pages)
+                missing = self.layout_cache.missing(page_numbers)
+                if 0 < len(missing) < len(page_numbers):
+                    # parse and cache the missing pages only
+                    self.pdf_query.get_tree(*missing)
+            self.pdf_query.load(*page_numbers)
+        profiling.count("pages_loaded", len(page_numbers))
+
+    def release(self):
+        """
+        Free the memory of the loaded layout tree.
+        """
+        self.pdf_query.tree = self.pdf_query.pq = None
+        # PDFQuery keeps a reference to every element ever created
+        self.pdf_query._elements = []
+        self._layout_index = self._layout_index_tree = None
+        gc.collect()
+
+    def close(self):
+        """
+        Release the layout tree and close the pdf file, with its memory map.
+        """
+        self.release()
+        self.pdf_query.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def load_batches(self, pages=None, max_memory=None):
+        """
+        Load the layout tree of the given pages, a batch at a time,
+        because PDFQuery.load can eat up all your RAM!
+
+        Without max_memory, batches have BATCH_SIZE pages. Otherwise
+        the memory used per page is measured while loading, and every
+        batch is sized to fit the remaining budget.
+        The previous batch is released before loading the next one,
+        while the last one stays loaded.
+        :param pages: the sorted page indexes to load, default all
+        :param max_memory: the memory budget of the process in bytes
+        :return: a generator with the page indexes loaded at each step
+        """
+        pages = range(self.num_pages) if pages is None else list(pages)
+        size = FIRST_BATCH_SIZE if max_memory else BATCH_SIZE
+        page_cost, i = 0, 0
+        while i < len(pages):
+            pgs = pages[i:i + size]
+            i += len(pgs)
+            self.release()
+            rss = current_rss()
+            self.load(*pgs)
+            if max_memory:
+                # keep the worst case, as pages have different density
+                page_cost = max(page_cost, (current_rss() - rss) / len(pgs))
+                budget = max_memory - rss
+                if budget <= 0:
+                    size = 1
+                elif page_cost:
+                    size = int(budget / page_cost)
+                else:
+                    # freed memory was reused, grow slowly
+                    size *= 2
+                size = min(max(size, 1), MAX_BATCH_SIZE)
+            yield pgs
+
+    @property
+    def layout_index(self):
+        """
+        The LayoutIndex of the loaded pages, built once per load.
+        """
+        tree = self.pdf_query.tree
+        if self._layout_index is None or self._layout_index_tree is not tree:
+            with profiling.stage("layout_index"):
+                self._layout_index = layoutindex.LayoutIndex(tree)
+            self._layout_index_tree = tree
+        return self._layout_index
 
     def get_clipping_position(self, clip):
         """
         Get the clipping position in a file, that is (page_index, rectangle)
         where rectangle is a 4-ple of points
         :param clip:
-        :param pdf_query: a PDFQuery object
-        :return: a 2-tuple of (page_index, 4-tuple coordinates)
-        """
-
-        # cleanup the clip before searching
-        clip = re_parens.sub("",  clip[:10])
-        q = ':contains("' + clip.decode(CODEC) + '")'
-        labels = self.pdf_query.pq(q)
-        # Labels is made of
-        # [ <page>, ..., <LTTextLineHorizontal> ]
-        # so we get page infos and find the right text object
-        if not labels:
+        :return: a 2-tuple of (page_index, 4-tuple coordinates) of the
+            first line of the clip
+        """
+        index = self.layout_index
+        with profiling.stage("locate"):
+            lines = index.find(clip)
+        if not lines:
             return
-        # Beware of PDFQuery.pageid as it varies after subsequent calls
-        #  of PDFQuery.load
-        page_index, height, width = (
-            float(labels[1].attrib[x]) for x in PDF_PAGE_FIELDS)
-
-        for label in labels:
-            # Find and element which
-            if not hasattr(label, 'layout'):
-                continue
-            l = label.layout
-            if isinstance(l, LTTextLineHorizontal):
-                # Coordinates are relative to the page size and
-                # y-cordinates are reversed respect to PDF format
-                return int(page_index), (float(l.x0)/width,
-                                         (height-float(l.y0))/height,
-                                         float(l.x1)/width,
-                                         (height - float(l.y1))/height)
+        return lines[0].page_index, lines[0].rectangle()
+
+    def get_clipping_positions(self, clip):
+        """
+        Get the rectangles of all the lines of a clip, grouped by page.
+        :param clip:
+        :return: a list of (page_index, [4-tuple coordinates, ...]),
+            empty if the clip is not found
+        """
+        positions = []
+        index = self.layout_index
+        with profiling.stage("locate"):
+            lines = index.find(clip)
+        for line in lines:
+            if not positions or positions[-1][0] != line.page_index:
+                positions.append((line.page_index, []))
+            positions[-1][1].append(line.rectangle())
+        return positions
 
-    def search_clippings_in_book(self, clippings, limit_page=None, limit_clips=None):
+    def search_clippings_in_book(self, clippings, limit_page=None, limit_clips=None,
+                                 strict=True):
         """
         Wrapper around the testable search_clippings_in_text
         :param book_file:
         :param clippings:
         :param limit_page:
         :param limit_clips:
-        :return:
+        :param strict: if False, skip the clippings not found
+        :return: a list of (page, clip)
         """
         book_title = self.get_title()
         title, book_clippings = clippingparser.find_clippings(
             book_title, clippings)
         if not title:
             raise ValueError("Clippings not found for %r" % self.book_file)
-        # Force evaluation of the generator...maybe there's a
-        # better way to implement the following algorithm
-        text_pages = list(self.pdf_to_text())
-        return clippingparser.search_clippings_in_text(book_clippings, text_pages)
+        text_pages = self.text_pages()
+        model = self.location_model()
+        try:
+            return list(clippingparser.search_clippings_in_text(
+                book_clippings, text_pages, limit_page, limit_clips, strict=strict,
+                model=model))
+        finally:
+            # keep what was learnt even when a clip is not found
+            self.save_location_model(model)
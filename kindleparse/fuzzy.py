@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    Approximate search of clippings in normalized text.
+
+    Kindle and pdf text differ in a few characters, eg. a hyphen or a
+    wrongly extracted glyph, so exact search misses some clips.
+    Bit-parallel algorithms keep the states of a pattern in the bits of
+    an integer, and python integers have no size limit:
+
+     - FuzzyMatcher packs the prefixes of many clips in the same
+       integers and finds the candidate pages with the bitap algorithm;
+     - best_match computes the edit distance of a candidate with
+       the Myers algorithm, giving its score.
+
+    Uses clippingparser
+"""
+from __future__ import unicode_literals, print_function, division
+import clippingparser
+
+# the prefix length of a clip used for fuzzy search
+FUZZY_LEN = 48
+# shorter clips are only searched exactly, as errors would match anything
+MIN_FUZZY_LEN = 20
+# the errors allowed per character
+MAX_ERROR_RATE = 0.1
+
+
+def max_errors(length, rate=MAX_ERROR_RATE):
+    return int(length * rate)
+
+
+def score(distance, length):
+    """
+    :return: 1.0 for an exact match, down to 0.0
+    """
+    return max(0.0, 1 - distance / length) if length else 0.0
+
+
+def char_masks(pattern, offset=0, masks=None):
+    """
+    Return a dict with the bits set at the positions of each char in pattern.
+    """
+    masks = {} if masks is None else masks
+    for i, c in enumerate(pattern):
+        masks[c] = masks.get(c, 0) | 1 << (offset + i)
+    return masks
+
+
+def best_match(pattern, text, k=None):
+    """
+    Find the best approximate occurrence of pattern in text, using
+    the bit-vector algorithm of Myers (1999).
+    :param pattern: the normalized pattern
+    :param text: the normalized text
+    :param k: the max edit distance accepted
+    :return: a couple (distance, end) where end is the position after
+        the match, or None if the distance is more than k
+    """
+    m = len(pattern)
+    if not m:
+        return None
+    eqs = char_masks(pattern)
+    mask, high = (1 << m) - 1, 1 << (m - 1)
+    pv, mv, distance = mask, 0, m
+    best, best_end = m, 0
+    for j, c in enumerate(text):
+        eq = eqs.get(c, 0)
+        xv = eq | mv
+        xh = (((((eq & pv) + pv) & mask) ^ pv) | eq)
+        ph = mv | (~(xh | pv) & mask)
+        mh = pv & xh
+        if ph & high:
+            distance += 1
+        elif mh & high:
+            distance -= 1
+        # searching, a match can start anywhere in the text
+        ph = (ph << 1) & mask
+        mh = (mh << 1) & mask
+        pv = mh | (~(xv | ph) & mask)
+        mv = ph & xv
+        if distance < best:
+            best, best_end = distance, j + 1
+            if not best:
+                break
+    if k is not None and best > k:
+        return None
+    return best, best_end
+
+
+def find(pattern, text, k):
+    """
+    Like best_match, but fast on long texts: when the pattern is split
+    in k + 1 pieces, one of them appears exactly in any match with k
+    errors. So only the text around the pieces found is checked.
+    :return: a couple (distance, end) or None
+    """
+    m = len(pattern)
+    if not m:
+        return None
+    pieces = k + 1
+    size = max(1, m // pieces)
+    best = None
+    checked = set()
+    for i in range(0, min(pieces * size, m), size):
+        piece = pattern[i:i + size]
+        pos = text.find(piece)
+        while pos >= 0:
+            start = max(0, pos - i - k)
+            if start not in checked:
+                checked.add(start)
+                match = best_match(pattern, text[start:pos - i + m + k], k)
+                if match and (best is None or match[0] < best[0]):
+                    best = match[0], start + match[1]
+                    if not best[0]:
+                        return best
+            pos = text.find(piece, pos + 1)
+    return best
+
+
+class FuzzyMatcher(object):
+    """
+    Find the pages containing each of a list of clippings, allowing
+    up to MAX_ERROR_RATE edits per character.
+    """
+
+    def __init__(self, clippings, length=FUZZY_LEN, rate=MAX_ERROR_RATE):
+        self.patterns = [clippingparser.cleanup_for_match(c)[:length] if c else ''
+                         for c in clippings]
+        self.rate = rate
+        self.masks, self.low, self.high = {}, 0, 0
+        # the bit of the last char of each pattern -> pattern index
+        self.ends = {}
+        offset = 0
+        for n, pattern in enumerate(self.patterns):
+            if len(pattern) < MIN_FUZZY_LEN:
+                continue
+            char_masks(pattern, offset, self.masks)
+            self.low |= 1 << offset
+            end = 1 << (offset + len(pattern) - 1)
+            self.high |= end
+            self.ends[end] = n
+            offset += len(pattern)
+        self.all = (1 << offset) - 1
+        self.k = max([max_errors(len(self.patterns[n]), rate)
+                      for n in self.ends.values()] or [0])
+        # with d errors, the first d chars of a pattern can be deleted
+        self.init = [0] * (self.k + 1)
+        for end, n in self.ends.items():
+            m = len(self.patterns[n])
+            start = end.bit_length() - m
+            for d in range(self.k + 1):
+                self.init[d] |= ((1 << min(d, m)) - 1) << start
+
+    def candidates(self, haystack):
+        """
+        Run the bitap algorithm with k errors on all the patterns at once.
+        :return: a dict {pattern index: the sorted ends of its occurrences}
+        """
+        masks, low, high, full, k = self.masks, self.low, self.high, self.all, self.k
+        states = list(self.init)
+        found = {}
+        for j, c in enumerate(haystack):
+            eq = masks.get(c, 0)
+            old = states[0]
+            new = ((old << 1) | low) & eq
+            states[0] = new
+            for d in range(1, k + 1):
+                prev_old, prev_new, old = old, new, states[d]
+                # match, insertion, substitution and deletion
+                new = ((((old << 1) | low) & eq) | prev_old | (prev_old << 1) |
+                       (prev_new << 1) | low) & full
+                states[d] = new
+            hits = new & high
+            while hits:
+                bit = hits & -hits
+                hits ^= bit
+                found.setdefault(self.ends[bit], []).append(j + 1)
+        return found
+
+    def search(self, haystack):
+        """
+        :param haystack: a normalized text
+        :return: a dict {pattern index: score} of the patterns in the text
+        """
+        scores = {}
+        if not self.ends:
+            return scores
+        for n, ends in self.candidates(haystack).items():
+            pattern = self.patterns[n]
+            # candidates use the k of the longest pattern, so check
+            # them with the k of this one
+            k = max_errors(len(pattern), self.rate)
+            checked = -1
+            for end in ends:
+                if end <= checked:
+                    continue
+                checked = end + self.k
+                window = haystack[max(0, end - len(pattern) - self.k):checked]
+                match = best_match(pattern, window, k)
+                if match:
+                    scores[n] = score(match[0], len(pattern))
+                    break
+        return scores
+
+    def scan(self, text_pages, pages=None):
+        """
+        :param text_pages: a sequence of page contents
+        :param pages: the page indexes to scan, default all
+        :return: a couple (hits, scores) where hits is a list with the
+            sorted page indexes of every clip, and scores a dict
+            {clip index: best score}
+        """
+        hits = [[] for _ in self.patterns]
+        scores = {}
+        if not self.ends:
+            return hits, scores
+        pages = xrange(len(text_pages)) if pages is None else pages
+        for i in pages:
+            content = text_pages[i]
+            if not content:
+                continue
+            for n, s in self.search(clippingparser.cleanup_for_match(content)).items():
+                hits[n].append(i)
+                scores[n] = max(s, scores.get(n, 0))
+        return hits, scores
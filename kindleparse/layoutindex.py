@@ -0,0 +1,166 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    A positional index of the text lines of a pdfquery layout tree.
+
+    The normalized text of every LTTextLineHorizontal is joined in a
+    single string, so that finding a clip - even when it spans many
+    lines or pages - is a substring search instead of a tree traversal.
+    The text of pages that are not adjacent is separated by a newline,
+    which normalized clips never contain.
+
+    Uses clippingparser and fuzzy
+"""
+from __future__ import unicode_literals, print_function, division
+from bisect import bisect_right
+import re
+import clippingparser
+import fuzzy
+
+LINE_TAG = 'LTTextLineHorizontal'
+PAGE_TAG = 'LTPage'
+PDF_PAGE_FIELDS = "page_index height width".split()  # get those fields from PDF
+BBOX_FIELDS = "x0 y0 x1 y1".split()
+# the shortest partial match accepted for a clip
+MIN_PREFIX_LEN = 30
+# a raw line ending with a broken word, eg. "transac-", like the
+# ones joined by clippingparser.re_hyphenation
+re_broken = re.compile(r"\w([-\xad])\s*$", re.UNICODE)
+re_word_start = re.compile(r"\w", re.UNICODE)
+# separates the text of pages that are not adjacent
+PAGE_BREAK = "\n"
+
+
+class TextLine(object):
+    """
+    A text line in a page: coordinates are in pdf points.
+    """
+    __slots__ = ('page_index', 'height', 'width', 'x0', 'y0', 'x1', 'y1')
+
+    def __init__(self, page_index, height, width, x0, y0, x1, y1):
+        self.page_index = page_index
+        self.height, self.width = height, width
+        self.x0, self.y0, self.x1, self.y1 = x0, y0, x1, y1
+
+    def rectangle(self):
+        """
+        Return the line rectangle relative to the page size.
+        y-coordinates are reversed respect to PDF format.
+        """
+        return (self.x0 / self.width,
+                (self.height - self.y0) / self.height,
+                self.x1 / self.width,
+                (self.height - self.y1) / self.height)
+
+    def __repr__(self):
+        return "<TextLine %d %r>" % (
+            self.page_index, (self.x0, self.y0, self.x1, self.y1))
+
+
+class LayoutIndex(object):
+    """
+    Index the text lines of the pages loaded in a pdfquery tree.
+    """
+
+    def __init__(self, tree):
+        """
+        :param tree: the lxml tree of PDFQuery.load
+        """
+        self.lines = []
+        self.starts = []
+        # the offsets where the text after a PAGE_BREAK starts
+        self.breaks = []
+        parts, offset, last_page, broken = [], 0, None, None
+        for page in tree.getroot().iter(PAGE_TAG):
+            page_index, height, width = (
+                float(page.attrib[x]) for x in PDF_PAGE_FIELDS)
+            adjacent = last_page is None or int(page_index) == last_page + 1
+            last_page = int(page_index)
+            for el in page.iter(LINE_TAG):
+                raw = "".join(el.itertext())
+                text = clippingparser.cleanup_for_match(raw)
+                if not text:
+                    continue
+                x0, y0, x1, y1 = (float(el.attrib[x]) for x in BBOX_FIELDS)
+                self.lines.append(
+                    TextLine(int(page_index), height, width, x0, y0, x1, y1))
+                if parts and not adjacent:
+                    parts.append(PAGE_BREAK)
+                    offset += len(PAGE_BREAK)
+                    self.breaks.append(offset)
+                elif parts and broken and re_word_start.match(text):
+                    # join the broken word, as cleanup_for_match does:
+                    # folding already removed a soft hyphen
+                    if broken == "-":
+                        parts[-1] = parts[-1][:-1]
+                        offset -= 1
+                elif parts:
+                    parts.append(" ")
+                    offset += 1
+                self.starts.append(offset)
+                parts.append(text)
+                offset += len(text)
+                adjacent = True
+                # check the raw text, as folding turns dashes into "-"
+                m = re_broken.search(raw)
+                broken = m and m.group(1)
+        self.text = "".join(parts)
+
+    def find_prefix(self, needle):
+        """
+        Find the longest prefix of needle in the text.
+        :return: a couple (start, length), where start is -1 if
+            not even the first character is found
+        """
+        lo, hi, start = 0, len(needle), -1
+        # if a prefix is found, all the shorter ones are found too
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            pos = self.text.find(needle[:mid])
+            if pos < 0:
+                hi = mid - 1
+            else:
+                lo, start = mid, pos
+        return start, lo
+
+    def find_approximate(self, needle):
+        """
+        Find the start of the fuzzy.FUZZY_LEN characters prefix of
+        needle, allowing a few errors.
+        :return: the start position, or -1
+        """
+        pattern = needle[:fuzzy.FUZZY_LEN]
+        if len(pattern) < fuzzy.MIN_FUZZY_LEN:
+            return -1
+        match = fuzzy.find(pattern, self.text, fuzzy.max_errors(len(pattern)))
+        if match is None:
+            return -1
+        return max(0, match[1] - len(pattern))
+
+    def find(self, clip):
+        """
+        Find the lines containing a clip. When the whole clip is not
+        found, eg. because the pdf text differs somewhere, accept its
+        longest prefix if at least MIN_PREFIX_LEN characters long, or
+        an approximate match of its beginning.
+        :param clip: a Clipping or a string
+        :return: a list of TextLine, empty if the clip is not found
+        """
+        needle = clippingparser.cleanup_for_match(clip)
+        if not needle:
+            return []
+        start, length = self.find_prefix(needle)
+        if length < min(len(needle), MIN_PREFIX_LEN):
+            start = self.find_approximate(needle)
+            if start < 0:
+                return []
+        # the clip is supposed to take as many characters
+        # as its text, even when only a prefix matches,
+        # but it can't continue in a page that is not adjacent
+        end = start + len(needle) - 1
+        b = bisect_right(self.breaks, start)
+        if b < len(self.breaks):
+            end = min(end, self.breaks[b] - 1)
+        first = bisect_right(self.starts, start) - 1
+        last = bisect_right(self.starts, end) - 1
+        return self.lines[first:last + 1]
@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    Locate many clippings in many pages with a single scan of the text.
+
+    Every page is normalized once, then an Aho-Corasick automaton
+    built over the prefixes of all clippings reports every
+    (clip, page) hit. Clips not found are then searched
+    approximately, see fuzzy.
+
+    Uses clippingparser and fuzzy
+"""
+from __future__ import unicode_literals, print_function
+from collections import deque
+import clippingparser
+import fuzzy
+
+# the prefix length used to match clippings, see find_clipping_in_page
+NEEDLE_LEN = 15
+# hits of a needle where the longer prefix scores less are rejected
+MIN_SCORE = 1 - fuzzy.MAX_ERROR_RATE
+
+
+class Automaton(object):
+    """
+    An Aho-Corasick automaton: finds all the occurrences of a set of
+    patterns in a text in time proportional to the text length.
+    """
+
+    def __init__(self, patterns):
+        """
+        :param patterns: an iterable of (key, pattern). Many keys
+            can share the same pattern.
+        """
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for key, pattern in patterns:
+            self.add(key, pattern)
+        self.build()
+
+    def add(self, key, pattern):
+        state = 0
+        for c in pattern:
+            nxt = self.goto[state].get(c)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][c] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            state = nxt
+        self.out[state].append(key)
+
+    def build(self):
+        """
+        Compute the failure links, breadth first.
+        """
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for c, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and c not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(c, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def search(self, text):
+        """
+        :param text: the text to scan
+        :return: a generator of (end, key) for every pattern occurrence,
+            where end is the position after the match
+        """
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        for i, c in enumerate(text):
+            while state and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            for key in out[state]:
+                yield i + 1, key
+
+
+def clip_needle(clip):
+    """
+    Return the normalized text used to search a clip.
+    """
+    return clippingparser.cleanup_for_match(clip)[:NEEDLE_LEN]
+
+
+class PageMatcher(object):
+    """
+    Find the pages containing each of a list of clippings.
+
+    After a scan, scores has the best match score of every clip found,
+    from 1.0 for an exact match of its first fuzzy.FUZZY_LEN characters
+    down to MIN_SCORE.
+    """
+
+    def __init__(self, clippings, approximate=True):
+        """
+        :param clippings: a list of clippings
+        :param approximate: search the clips not found with fuzzy.FuzzyMatcher
+        """
+        self.clippings = clippings
+        self.approximate = approximate
+        prefixes = [clippingparser.cleanup_for_match(c)[:fuzzy.FUZZY_LEN] if c else ''
+                    for c in clippings]
+        self.prefixes = prefixes
+        self.needles = [p[:NEEDLE_LEN] for p in prefixes]
+        self.automaton = Automaton(
+            (n, needle) for n, needle in enumerate(self.needles) if needle)
+        self.scores = {}
+
+    def verify(self, n, haystack, end):
+        """
+        Compare the prefix of clip n with the text at a hit. The page
+        may end before the prefix, when the clip spans two pages.
+        :return: the score of the hit
+        """
+        prefix = self.prefixes[n]
+        start = end - len(self.needles[n])
+        prefix = prefix[:len(haystack) - start]
+        if haystack.startswith(prefix, start):
+            return 1.0
+        k = fuzzy.max_errors(len(prefix))
+        match = fuzzy.best_match(prefix, haystack[start:start + len(prefix) + k])
+        return fuzzy.score(match[0], len(prefix))
+
+    def scan(self, text_pages, pages=None):
+        """
+        Scan the pages once, plus once more when some clips are not
+        found and text_pages is a sequence.
+
+        A 15 characters prefix can match in many places: the hits where
+        the longer prefix scores less than MIN_SCORE are rejected, and
+        when it matches exactly in some pages, the other ones are dropped.
+        :param text_pages: an iterable of page contents
+        :param pages: the page indexes to scan, default all. Requires
+            text_pages to be a sequence.
+        :return: a list with the sorted page indexes of every clip, eg.
+            [ [0, 3], [], [3], ...]
+        """
+        hits = [[] for _ in self.needles]
+        scores = [[] for _ in self.needles]
+        if pages is None:
+            indexed = enumerate(text_pages)
+        else:
+            indexed = ((i, text_pages[i]) for i in pages)
+        for i, content in indexed:
+            if not content:
+                continue
+            haystack = clippingparser.cleanup_for_match(content)
+            best = {}
+            for end, n in self.automaton.search(haystack):
+                if best.get(n) != 1.0:
+                    best[n] = max(best.get(n, 0), self.verify(n, haystack, end))
+            for n, s in best.items():
+                if s >= MIN_SCORE:
+                    hits[n].append(i)
+                    scores[n].append(s)
+        self.scores = {}
+        for n, (found, page_scores) in enumerate(zip(hits, scores)):
+            if not found:
+                continue
+            top = max(page_scores)
+            if top == 1.0:
+                hits[n] = [p for p, s in zip(found, page_scores) if s == 1.0]
+            self.scores[n] = top
+        missing = [n for n, h in enumerate(hits) if not h and self.needles[n]]
+        if self.approximate and missing and hasattr(text_pages, '__getitem__'):
+            fuzzy_hits, fuzzy_scores = fuzzy.FuzzyMatcher(
+                [self.clippings[n] for n in missing]).scan(text_pages, pages)
+            for i, n in enumerate(missing):
+                if fuzzy_hits[i]:
+                    hits[n] = fuzzy_hits[i]
+                    self.scores[n] = fuzzy_scores[i]
+        return hits
@@ -2,11 +2,19 @@
     Writes the xml annotations file. Must be aware of the codec used by pdf parser
 """
 from __future__ import unicode_literals, print_function, division
+import os
+import tempfile
 import uuid
-from xml.etree.ElementTree import Element, ElementTree
-from os.path import basename, join as pjoin, getsize, expanduser
+from xml.etree.ElementTree import Element, tostring, parse
+from xml.sax.saxutils import quoteattr
+from os.path import basename, dirname, join as pjoin, getsize, expanduser
 from collections import defaultdict
 from clippablepdf import CODEC as PDF_CODEC
+from clippingparser import get_text, Clipping, MatchReport, PendingClippings
+from profiling import current_rss
+import calibration
+from time import time
+import profiling
 import logging
 log = logging.getLogger(__name__)
 REVISION_LINE_SEP = b'&#xa;'
@@ -22,6 +30,49 @@ def mk_destfile(filepath):
                  )
 
 
+def stable_name(clip, part=0):
+    """
+    Return an okular uniqueName derived from the clip text, so that
+    the same clip always gets the same name. The title and location
+    of a Clipping are part of the name, so that highlights with the
+    same text in different places get different names.
+    :param clip: a Clipping or a string
+    :param part: the index of the annotation, when a clip needs many
+    """
+    text = get_text(clip)
+    if isinstance(text, unicode):
+        text = text.encode(PDF_CODEC)
+    if isinstance(clip, Clipping):
+        text = b"%s\0%s-%s\0%s" % (clip.title, clip.start, clip.end, text)
+    if part:
+        text += b"\0%d" % part
+    return "okular-{%s}" % str(uuid.uuid5(uuid.NAMESPACE_URL, text))
+
+
+class DocumentInfo(object):
+    """
+    An existing okular documentInfo file, read back to be merged.
+
+    pages maps page indexes to page elements, names is the set of
+    annotation uniqueNames.
+    """
+
+    def __init__(self, destfile_xml):
+        self.root = parse(bytes(destfile_xml)).getroot()
+        self.pages = {}
+        self.names = set()
+        pageList = self.root.find('pageList')
+        if pageList is not None:
+            for page in pageList.findall('page'):
+                self.pages[int(page.get('number'))] = page
+                self.names.update(
+                    base.get('uniqueName') for base in page.iter('base'))
+            self.root.remove(pageList)
+
+    def __contains__(self, clip):
+        return stable_name(clip) in self.names
+
+
 class BaseNote(Element):
     def __init__(self, **kwds):
         attrib = {
@@ -53,7 +104,116 @@ class Page(Element):
         self.append(Element('annotationList'))
 
 
-def create_highlight(points):
+class DocumentWriter(object):
+    """
+    Write an okular documentInfo file incrementally.
+
+    Annotations are buffered by page, and every flush() writes the
+    buffered pages and frees them: flush a page only once it is
+    complete, or it will be written twice. The file is written to a temporary
+    file which replaces the destination only when the writer is closed
+    without errors.
+
+        with DocumentWriter(destfile_xml) as writer:
+            writer.add(page_index, annotation)
+            writer.flush()
+    """
+
+    def __init__(self, destfile_xml, existing=None):
+        """
+        :param destfile_xml: the destination file
+        :param existing: a DocumentInfo whose pages and annotations
+            are kept in the new file
+        """
+        assert destfile_xml.endswith(".xml")
+        self.destfile = bytes(destfile_xml)
+        self.existing = existing
+        self.pages = defaultdict(list)
+        self.fh = self.tmpfile = None
+
+    def open(self):
+        fd, self.tmpfile = tempfile.mkstemp(
+            suffix=b".tmp", dir=dirname(self.destfile) or b".")
+        self.fh = os.fdopen(fd, 'wb')
+        # mkstemp creates private files
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(self.tmpfile, 0o666 & ~umask)
+        url = self.destfile.decode(PDF_CODEC, 'replace')
+        if self.existing is not None:
+            url = self.existing.root.get('url', url)
+        self.fh.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+        self.fh.write(("<documentInfo url=%s><pageList>" % quoteattr(url))
+                      .encode('utf-8'))
+
+    def add(self, page_index, annotation):
+        """
+        Add an annotation to a page.
+        """
+        self.pages[page_index].append(annotation)
+
+    def write_page(self, page_index, annotations):
+        """
+        Write a page with its annotations, and the existing ones.
+        """
+        page = None
+        if self.existing is not None:
+            page = self.existing.pages.pop(page_index, None)
+        if page is None:
+            page = Page(page_index)
+        # There's only one annotationList per page
+        annotationList = page.find('annotationList')
+        if annotationList is None:
+            annotationList = Element('annotationList')
+            page.append(annotationList)
+        for annotation in annotations:
+            annotationList.append(annotation)
+        with profiling.stage("write_xml"):
+            self.fh.write(tostring(page, encoding='utf-8'))
+
+    def flush(self, pages=None):
+        """
+        Write the buffered annotations of the given pages.
+        :param pages: a list of page indexes, default all
+        """
+        if pages is None:
+            pages = sorted(self.pages)
+        for page_index in pages:
+            annotations = self.pages.pop(page_index, None)
+            if annotations:
+                self.write_page(page_index, annotations)
+
+    def close(self):
+        self.flush()
+        if self.existing is not None:
+            for page_index in sorted(self.existing.pages):
+                self.fh.write(tostring(self.existing.pages[page_index], encoding='utf-8'))
+            self.fh.write(b"</pageList>")
+            # eg. generalInfo
+            for child in self.existing.root:
+                self.fh.write(tostring(child, encoding='utf-8'))
+            self.fh.write(b"</documentInfo>")
+        else:
+            self.fh.write(b"</pageList></documentInfo>")
+        self.fh.close()
+        os.rename(self.tmpfile, self.destfile)
+
+    def abort(self):
+        self.fh.close()
+        os.unlink(self.tmpfile)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def create_highlight(points, name=None):
     """
 
     Highlight in Okular overlays is done via set of rectangles.
@@ -76,86 +236,160 @@ def create_highlight(points):
       feather="1"/>
      </hl>
 
-    :return:
+    A multi-line highlight has one quad per line, and the boundary
+    is the smallest box containing all of them.
+
+    :param points: a 4-ple of coordinates (x0, y0, x1, y1) relative to
+        the page size, or a list of them
+    :param name: the uniqueName, default random
+    :return: an AnnotationHL
     """
-    x0, y0, x1, y1 = map(str, points)
+    if not isinstance(points[0], (list, tuple)):
+        points = [points]
+    xs = [x for p in points for x in (p[0], p[2])]
+    ys = [y for p in points for y in (p[1], p[3])]
     annotation = AnnotationHL()
-    base = BaseNote(flags="0")
+    base = BaseNote(flags="0", uniqueName=name)
     annotation.append(base)
     boundary = Element(
-        'boundary', attrib=dict(l="0",
-                                r=".3",
-                                t="0",
-                                b="1")
+        'boundary', attrib=dict(l=str(min(xs)),
+                                r=str(max(xs)),
+                                t=str(min(ys)),
+                                b=str(max(ys)))
     )
     base.append(boundary)
     hl = Element('hl')
-    hl.append(Element('quad', attrib=dict(
-        feather="1",
-        ax=x0, ay=y1,
-        bx=x1, by=y1,
-        cx=x1, cy=y0,
-        dx=x0, dy=y0
-        )))
+    for p in points:
+        x0, y0, x1, y1 = map(str, p)
+        hl.append(Element('quad', attrib=dict(
+            feather="1",
+            ax=x0, ay=y1,
+            bx=x1, by=y1,
+            cx=x1, cy=y0,
+            dx=x0, dy=y0
+            )))
     annotation.append(hl)
     return annotation
 
 
-def create_xml_file_hl2(destfile_xml, clippings, pdf_parser):
+def load_existing(destfile_xml):
+    """
+    Return the DocumentInfo of destfile_xml, or None if it doesn't exist.
+    """
+    if os.path.isfile(destfile_xml):
+        return DocumentInfo(destfile_xml)
+
+
+def page_plan(pdf_parser, clippings, prefilter=True, model=None):
+    """
+    Return the lists of pages to load to find the clippings.
+
+    With a calibrated model, first load the pages predicted from the clip
+    locations. With prefilter, then load only the pages whose text contains
+    a clip and the ones after them, where the clip may continue, then -
+    if some clip is not in the text - the other ones.
+    Pages are never planned twice.
+    :param pdf_parser: a ClippablePDF
+    :param clippings: a list of clippings, or a function returning the
+        ones still to find: the text pages are then planned only for
+        the clippings not found in the predicted pages
+    :param prefilter: use the page text to skip pages
+    :param model: a calibration.LocationModel
+    :return: a generator of sorted page lists
+    """
+    current = clippings if callable(clippings) else lambda: clippings
+    planned = set()
+    if model is not None and model.ready():
+        predicted = sorted(set(
+            p for c in current()
+            for p in model.window(calibration.location(c)) or ()))
+        log.info("Clippings are predicted in pages %r" % predicted)
+        if predicted:
+            planned.update(predicted)
+            yield predicted
+    rest = current()
+    if not rest:
+        return
+    for pages in _text_plan(pdf_parser, rest, prefilter):
+        pages = [p for p in pages if p not in planned]
+        if pages:
+            planned.update(pages)
+            yield pages
+
+
+def _text_plan(pdf_parser, clippings, prefilter):
+    if not prefilter:
+        yield range(pdf_parser.num_pages)
+        return
+    candidates, unmatched = pdf_parser.candidate_pages(clippings)
+    log.info("Clippings are in pages %r" % candidates)
+    yield candidates
+    if unmatched:
+        log.info("Clippings not in the text: %r" % unmatched)
+        candidates = set(candidates)
+        yield [p for p in xrange(pdf_parser.num_pages) if p not in candidates]
+
+
+def create_xml_file_hl2(destfile_xml, clippings, pdf_parser, max_memory=None,
+                        prefilter=True, merge=False):
     """
 
     :param destfile_xml: the destination file
     :param clippings: a list of clippings
     :param pdf_parser: a PDFParser object
-    :return: None
-    """
-    assert destfile_xml.endswith(".xml")
-    clippings = list(clippings)
-    documentInfo = Element('documentInfo', attrib={'url': destfile_xml})
-    pageList = Element('pageList')
-    pages = {}
-    found = []
-    for i in xrange(0, pdf_parser.num_pages, 20):
-        # search on 20 pages at a time
-        # to limit memory consumption.
-        # PDFQuery.load can eat up all your RAM!
-        pgs = range(i, min(i + 20, pdf_parser.num_pages))
-        log.info("loading pages %r" % pgs)
-        pdf_parser.pdf_query.load(*pgs)
-
-        # don't search twice the same elements
-        # this is not expensive as the PDFQuery.load
-        # so it's ok
-        while found:
-            clippings.remove(found.pop())
-
-        log.info("Searching for %r" % clippings)
-        for clip in clippings:
-            ret = pdf_parser.get_clipping_position(clip)
-            if not ret:
-                log.info("Can't find clip: %r" % clip)
-                continue
-            # remove item from clippings
-            found.append(clip)
-            page_index, points = ret
-            if page_index not in pages:
-                # Prepare the page structure where
-                # to insert annotation
-                pages[page_index] = Page(page_index)
-                pageList.append(pages[page_index])
-
-            page = pages[page_index]
-            annotation = create_highlight(points)
-            # There's only one annotationList per page
-            annotationList = page.getchildren()[0]
-            annotationList.append(annotation)
-            text_icon = Element('text', attrib=dict(icon="Comment", type="1"))
-            annotation.append(text_icon)
-
-    # Write the xml document
-    documentInfo.append(pageList)
-    xmldoc = ElementTree(element=documentInfo)
-    xmldoc.write(bytes(destfile_xml), xml_declaration=True, encoding="UTF-8")
+    :param max_memory: the memory budget in bytes, see ClippablePDF.load_batches
+    :param prefilter: load only the pages that may contain clippings,
+        see page_plan
+    :param merge: keep the annotations of the existing destfile_xml,
+        and add only the clippings it doesn't contain
+    :return: a MatchReport with the first page of every found clip
+    """
+    existing = load_existing(destfile_xml) if merge else None
+    clippings = [c for c in clippings if existing is None or c not in existing]
+    pending = PendingClippings(clippings)
+    model = pdf_parser.location_model()
+    with DocumentWriter(destfile_xml, existing) as writer:
+        for plan in page_plan(pdf_parser, pending.clippings, prefilter, model):
+            if not pending:
+                break
+            # search on a few pages at a time
+            # to limit memory consumption.
+            start = time()
+            for pgs in pdf_parser.load_batches(plan, max_memory=max_memory):
+                log.info("loaded pages %r" % pgs)
+
+                # placed clips are removed from pending,
+                # so they are not searched twice
+                for state in pending:
+                    clip = state.clip
+                    positions = pdf_parser.get_clipping_positions(clip)
+                    if not positions:
+                        log.info("Can't find clip: %r" % clip)
+                        pending.miss(state.n)
+                        continue
+                    pending.place(state.n, positions[0][0], positions)
+                    model.add(calibration.location(clip), positions[0][0])
+                    # a clip across a page break has a highlight per page
+                    for part, (page_index, points) in enumerate(positions):
+                        annotation = create_highlight(points, stable_name(clip, part))
+                        text_icon = Element('text', attrib=dict(icon="Comment", type="1"))
+                        annotation.append(text_icon)
+                        writer.add(page_index, annotation)
+                # pages are loaded once, so they are complete
+                writer.flush(pgs)
+                log.info("pages %d-%d: %s" % (pgs[0], pgs[-1], pending.progress()))
+                if profiling.enabled():
+                    profiling.record("batch", pages=len(pgs), placed=len(pending.placed),
+                                     seconds=time() - start, rss=current_rss())
+                    start = time()
+                if not pending:
+                    # all clippings found
+                    break
+    pdf_parser.save_location_model(model)
+    report = pending.report()
+    profiling.count("clips_found", len(report.found))
+    profiling.count("clips_missed", len(report.missed))
+    return report
 
 
 def create_xml_file_hl(destfile_xml, paged_clippings, pdf_query):
@@ -166,35 +400,27 @@ def create_xml_file_hl(destfile_xml, paged_clippings, pdf_query):
             eg [ (1, 'here comes the sun'),
                 (2, 'nananana'),
                 (2, 'all right'), ..]
+        @return a MatchReport with the first page of every found clip
     """
-    assert destfile_xml.endswith(".xml")
-    paged_clippings_dict = defaultdict(list)
-    for p, c in paged_clippings:
-        paged_clippings_dict[p].append(c)
-
-    documentInfo = Element('documentInfo', attrib={'url': destfile_xml})
-    pageList = Element('pageList')
-
-    for p_num, p_clippings in paged_clippings_dict.items():
-        log.info("%r" % p_clippings)
-        page = Element('page', attrib={'number': str(p_num-1)})
-        pageList.append(page)
-        annotationList = Element('annotationList')
-        page.append(annotationList)
-        for i, clip in enumerate(p_clippings):
-            pageid, points = pdf_query.get_clipping_position(clip)
-            annotation = create_highlight(points)
-            annotationList.append(annotation)
-            text_icon = Element('text', attrib=dict(icon="Comment", type="1"))
-            annotation.append(text_icon)
-
-    # Write the xml document
-    documentInfo.append(pageList)
-    xmldoc = ElementTree(element=documentInfo)
-    xmldoc.write(bytes(destfile_xml), xml_declaration=True, encoding="UTF-8")
+    report = MatchReport()
+    with DocumentWriter(destfile_xml) as writer:
+        for n, (p_num, clip) in enumerate(paged_clippings):
+            positions = pdf_query.get_clipping_positions(clip)
+            if not positions:
+                log.warning("Can't find clip on page %r: %r" % (p_num, clip))
+                report.missed.append((n, clip))
+                continue
+            report.found.append((positions[0][0], clip))
+            # a clip across a page break has a highlight per page
+            for part, (page_index, points) in enumerate(positions):
+                annotation = create_highlight(points, stable_name(clip, part))
+                text_icon = Element('text', attrib=dict(icon="Comment", type="1"))
+                annotation.append(text_icon)
+                writer.add(page_index, annotation)
+    return report
 
 
-def create_xml_file(filepath, paged_clippings):
+def create_xml_file(filepath, paged_clippings, merge=False):
     """
         Create an xml file containing the clippings
         @param filepath - filename.xml
@@ -202,46 +428,41 @@ def create_xml_file(filepath, paged_clippings):
             eg [ (1, 'here comes the sun'),
                 (2, 'nananana'),
                 (2, 'all right'), ..]
+        @param merge - keep the annotations of the existing file,
+            and add only the clippings it doesn't contain
     """
-    assert filepath.endswith(".xml")
+    existing = load_existing(filepath) if merge else None
     paged_clippings_dict = defaultdict(list)
     for p, c in paged_clippings:
-        paged_clippings_dict[p].append(c)
-
-    documentInfo = Element('documentInfo', attrib={'url': filepath})
-    pageList = Element('pageList')
-
-    for p_num, p_clippings in paged_clippings_dict.items():
-        log.info("%r"%p_clippings)
-        page = Element('page', attrib={'number': str(p_num)})
-        pageList.append(page)
-        annotationList = Element('annotationList')
-        page.append(annotationList)
-        for pos, clip in enumerate(p_clippings):
-            annotation = AnnotationIL()
-            safe_but_ugly_text = clip
-            try:
-                safe_but_ugly_text = safe_but_ugly_text.decode(PDF_CODEC)\
-                    .encode('ascii', 'xmlcharrefreplace')\
-                    .replace(b"---", b"&#xa;")
-            except UnicodeError:
-                safe_but_ugly_text = repr(bytes(safe_but_ugly_text))
-            base = BaseNote(flags=4, opacity=0.8, text=safe_but_ugly_text)
-
-            top, bottom = .2*(1+pos/3), .2*(1+(pos+1)/3)
-            boundary = Element(
-                'boundary', attrib=dict(l="0",
-                                        r=".3",
-                                        t=str(top),
-                                        b=str(bottom))
-            )
-            base.append(boundary)
-            annotationList.append(annotation)
-            annotation.append(base)
-            text_icon = Element('text', attrib=dict(icon="Comment", type="1"))
-            annotation.append(text_icon)
-
-    # Write the xml document
-    documentInfo.append(pageList)
-    xmldoc = ElementTree(element=documentInfo)
-    xmldoc.write(bytes(filepath), xml_declaration=True, encoding="UTF-8")
+        if existing is None or c not in existing:
+            paged_clippings_dict[p].append(c)
+
+    with DocumentWriter(filepath, existing) as writer:
+        for p_num, p_clippings in paged_clippings_dict.items():
+            log.info("%r"%p_clippings)
+            annotations = []
+            for pos, clip in enumerate(p_clippings):
+                annotation = AnnotationIL()
+                safe_but_ugly_text = get_text(clip)
+                try:
+                    safe_but_ugly_text = safe_but_ugly_text.decode(PDF_CODEC)\
+                        .encode('ascii', 'xmlcharrefreplace')\
+                        .replace(b"---", b"&#xa;")
+                except UnicodeError:
+                    safe_but_ugly_text = repr(bytes(safe_but_ugly_text))
+                base = BaseNote(flags=4, opacity=0.8, text=safe_but_ugly_text,
+                                uniqueName=stable_name(clip))
+
+                top, bottom = .2*(1+pos/3), .2*(1+(pos+1)/3)
+                boundary = Element(
+                    'boundary', attrib=dict(l="0",
+                                            r=".3",
+                                            t=str(top),
+                                            b=str(bottom))
+                )
+                base.append(boundary)
+                annotation.append(base)
+                text_icon = Element('text', attrib=dict(icon="Comment", type="1"))
+                annotation.append(text_icon)
+                annotations.append(annotation)
+            writer.write_page(p_num, annotations)
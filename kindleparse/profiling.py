@@ -0,0 +1,192 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    Lightweight timers and counters for the conversion stages.
+
+    Instrumentation is disabled by default: stage() then returns a
+    shared no-op context manager and count() returns immediately.
+
+        profiling.enable()
+        with profiling.stage("load_layout"):
+            pdf.load(*pages)
+        profiling.count("pages_loaded", len(pages))
+        print(profiling.report())
+
+    Reading the resident set size costs a system call, so it is sampled
+    at most every RSS_INTERVAL seconds, or when a stage lasts longer.
+
+    Only the current process is measured: the stages run by pool
+    workers, eg. with --jobs, are not reported.
+"""
+from __future__ import unicode_literals, print_function, division
+from collections import OrderedDict
+from time import time
+import json
+import resource
+
+_enabled = False
+# name -> [calls, seconds, max rss in bytes]
+_stages = OrderedDict()
+_counters = OrderedDict()
+# name -> a list of dicts, eg. one per page batch
+_records = OrderedDict()
+_cprofile = None
+# the min seconds between two samples of the resident set size
+RSS_INTERVAL = 0.1
+_rss_sampled = 0.0
+
+
+def current_rss():
+    """
+    Return the resident set size of this process in bytes.
+    """
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        # the peak size, in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _NoStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+class _Stage(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        global _rss_sampled
+        now = time()
+        seconds = now - self.start
+        stats = _stages.get(self.name)
+        if stats is None:
+            stats = _stages[self.name] = [0, 0.0, 0]
+        stats[0] += 1
+        stats[1] += seconds
+        if seconds >= RSS_INTERVAL or now - _rss_sampled >= RSS_INTERVAL:
+            _rss_sampled = now
+            stats[2] = max(stats[2], current_rss())
+        return False
+
+
+def enabled():
+    return _enabled
+
+
+def enable(cprofile=False):
+    """
+    Start collecting stage timings.
+    :param cprofile: run cProfile too, see dump_cprofile
+    """
+    global _enabled, _cprofile
+    _enabled = True
+    if cprofile and _cprofile is None:
+        import cProfile
+        _cprofile = cProfile.Profile()
+        _cprofile.enable()
+
+
+def disable():
+    global _enabled, _cprofile
+    _enabled = False
+    if _cprofile is not None:
+        _cprofile.disable()
+
+
+def reset():
+    """
+    Discard the collected data.
+    """
+    global _cprofile, _rss_sampled
+    _rss_sampled = 0.0
+    _stages.clear()
+    _counters.clear()
+    _records.clear()
+    _cprofile = None
+
+
+def stage(name):
+    """
+    Time a stage, eg. with stage("pdf_to_text"): ...
+    Nested stages are timed independently.
+    """
+    if not _enabled:
+        return _NO_STAGE
+    return _Stage(name)
+
+
+def count(name, n=1):
+    """
+    Increment a counter.
+    """
+    if _enabled:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def record(name, **fields):
+    """
+    Append an entry to a trace, eg. record("batch", pages=20, seconds=1.2)
+    """
+    if _enabled:
+        _records.setdefault(name, []).append(fields)
+
+
+def to_dict():
+    """
+    :return: the collected data, ready to be serialized as json
+    """
+    return dict(
+        stages=OrderedDict(
+            (name, dict(calls=calls, seconds=seconds, max_rss=rss))
+            for name, (calls, seconds, rss) in _stages.items()),
+        counters=OrderedDict(_counters),
+        records=OrderedDict(_records),
+        peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    )
+
+
+def dump_json(path):
+    with open(path, 'w') as fh:
+        json.dump(to_dict(), fh, indent=2)
+
+
+def dump_cprofile(path):
+    """
+    Save the cProfile stats, to be read with pstats.
+    """
+    if _cprofile is not None:
+        _cprofile.disable()
+        _cprofile.dump_stats(path)
+
+
+def report():
+    """
+    :return: a text table with the time spent in each stage and the counters
+    """
+    lines = ["%-24s %8s %10s %10s" % ("stage", "calls", "seconds", "max MB")]
+    for name, (calls, seconds, rss) in _stages.items():
+        lines.append("%-24s %8d %10.3f %10.1f" % (name, calls, seconds, rss / (1 << 20)))
+    for name, value in _counters.items():
+        lines.append("%-24s %8d" % (name, value))
+    batches = _records.get("batch", [])
+    if batches:
+        lines.append("%-24s %8s %10s %10s" % ("batch", "pages", "seconds", "rss MB"))
+    for n, b in enumerate(batches):
+        lines.append("%-24d %8d %10.3f %10.1f" % (
+            n, b['pages'], b['seconds'], b['rss'] / (1 << 20)))
+    return "\n".join(lines)
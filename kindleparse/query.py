@@ -0,0 +1,257 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    List, filter and export clippings without opening any pdf.
+
+    Clippings are stored in a sqlite index next to the other caches.
+    The index remembers the offset where parsing stopped, so when the
+    Kindle appends new clippings only those are parsed.
+
+    Usage:
+
+        # python kindle2okular.py query -c "My Clippings.txt" --books
+        # python kindle2okular.py query -c "My Clippings.txt" --author wu --since 2014-01-01
+        # python kindle2okular.py query -c "My Clippings.txt" --title altai --format csv
+
+    Uses clippingparser and cache
+"""
+from __future__ import unicode_literals, print_function
+from calendar import timegm
+from datetime import datetime
+from os import stat
+from os.path import abspath, join as pjoin
+import argparse
+import csv
+import hashlib
+import json
+import sqlite3
+import sys
+import clippingparser
+import cache
+
+# the bytes at the start and before the offset of a file used
+# to check that it was only appended to, see checkpoint
+HEAD_SIZE = 4096
+FIELDS = "title author kind start end page date text".split()
+
+
+def _decode(s):
+    if isinstance(s, unicode):
+        return s
+    return s.decode(clippingparser.clippablepdf.CODEC, 'replace')
+
+
+def _contains(haystack, needle):
+    return haystack is not None and needle.lower() in haystack.lower()
+
+
+def head_digest(path, size):
+    """
+    Return the sha1 hex digest of the first size bytes of a file.
+    """
+    with open(path, 'rb') as fh:
+        return hashlib.sha1(fh.read(size)).hexdigest()
+
+
+def tail_digest(path, end, size):
+    """
+    Return the sha1 hex digest of the size bytes before end in a file.
+    """
+    with open(path, 'rb') as fh:
+        fh.seek(end - size)
+        return hashlib.sha1(fh.read(size)).hexdigest()
+
+
+def checkpoint(path, offset):
+    """
+    Return the digests of the HEAD_SIZE bytes at the start of a file
+    and before offset: they change when the file is rewritten or
+    truncated, instead of only appended to.
+    """
+    size = min(offset, HEAD_SIZE)
+    return "%s:%s" % (head_digest(path, size), tail_digest(path, offset, size))
+
+
+class ClippingIndex(object):
+    """
+    A persistent index of the entries of My Clippings.txt files.
+    """
+    filename = "clippings.sqlite"
+
+    def __init__(self, cache_dir=cache.CACHE_HOME):
+        """
+        :param cache_dir: where to store the index. If None, the
+            index is kept in memory.
+        """
+        path = ":memory:"
+        if cache_dir:
+            path = pjoin(cache.mk_cache_dir(cache_dir), self.filename)
+        self.db = sqlite3.connect(path, timeout=cache.DB_TIMEOUT)
+        self.db.create_function("contains", 2, _contains)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, size INTEGER, mtime REAL,
+                offset INTEGER, head TEXT);
+            CREATE TABLE IF NOT EXISTS clippings (
+                path TEXT, seq INTEGER, title_line TEXT, title TEXT,
+                author TEXT, kind TEXT, start INTEGER, end INTEGER,
+                page INTEGER, timestamp INTEGER, text TEXT,
+                PRIMARY KEY (path, seq));
+            CREATE INDEX IF NOT EXISTS clippings_timestamp
+                ON clippings (path, timestamp);
+        """)
+
+    @staticmethod
+    def _key(clippings_path):
+        return _decode(abspath(clippings_path))
+
+    def refresh(self, clippings_path):
+        """
+        Index the entries added since the last refresh. If the file
+        was not only appended to, it is indexed again.
+        :param clippings_path: path to file
+        :return: the number of new entries
+        """
+        key = self._key(clippings_path)
+        st = stat(clippings_path)
+        row = self.db.execute(
+            "SELECT size, mtime, offset, head FROM files WHERE path=?",
+            (key, )).fetchone()
+        offset, seq = 0, 0
+        if row:
+            size, mtime, offset, head = row
+            if (size, mtime) == (st.st_size, st.st_mtime):
+                return 0
+            if st.st_size < offset or head != checkpoint(clippings_path, offset):
+                offset = 0
+        with self.db:
+            if offset:
+                seq = self.db.execute(
+                    "SELECT COUNT(*) FROM clippings WHERE path=?", (key, )).fetchone()[0]
+            else:
+                self.db.execute("DELETE FROM clippings WHERE path=?", (key, ))
+            rows = []
+            for offset, title_line, notes, text in clippingparser.iter_clippings(
+                    clippings_path, offset):
+                title, author = clippingparser.split_title(title_line)
+                kind, start, end, page, timestamp = clippingparser.parse_metadata(notes)
+                rows.append((key, seq + len(rows), _decode(title_line), title, author,
+                             kind, start, end, page, timestamp, _decode(text)))
+            self.db.executemany(
+                "INSERT INTO clippings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (key, st.st_size, st.st_mtime, offset,
+                 checkpoint(clippings_path, offset)))
+        return len(rows)
+
+    def query(self, clippings_path, title=None, author=None, since=None,
+              until=None, kind=None):
+        """
+        Find clippings, in the order of the file. Refresh the index first.
+        :param title: a case insensitive substring of the book title
+        :param author: a case insensitive substring of the author
+        :param since: only clippings added at or after this epoch time
+        :param until: only clippings added before this epoch time
+        :param kind: eg. clippingparser.HIGHLIGHT
+        :return: a generator of Clipping
+        """
+        self.refresh(clippings_path)
+        where, params = ["path=?"], [self._key(clippings_path)]
+        for op, value in (("contains(title, ?)", title),
+                          ("contains(author, ?)", author),
+                          ("timestamp>=?", since),
+                          ("timestamp<?", until),
+                          ("kind=?", kind)):
+            if value is not None:
+                where.append(op)
+                params.append(value)
+        rows = self.db.execute(
+            "SELECT title_line, text, kind, start, end, page, timestamp"
+            " FROM clippings WHERE %s ORDER BY seq" % " AND ".join(where), params)
+        codec = clippingparser.clippablepdf.CODEC
+        for title_line, text, kind, start, end, page, timestamp in rows:
+            yield clippingparser.Clipping(
+                title_line.encode(codec), text.encode(codec),
+                kind, start, end, page, timestamp)
+
+    def books(self, clippings_path):
+        """
+        Refresh the index and list the books.
+        :return: a list of (title_line, clippings count, last timestamp)
+        """
+        self.refresh(clippings_path)
+        return self.db.execute(
+            "SELECT title_line, COUNT(*), MAX(timestamp) FROM clippings"
+            " WHERE path=? GROUP BY title_line ORDER BY title_line",
+            (self._key(clippings_path), )).fetchall()
+
+
+def to_dict(clip):
+    """
+    :return: a dict with the FIELDS of a Clipping, ready for json
+    """
+    codec = clippingparser.clippablepdf.CODEC
+    title, author = clippingparser.split_title(clip.title)
+    date = clip.date
+    return dict(title=title, author=author, kind=clip.kind, start=clip.start,
+                end=clip.end, page=clip.page,
+                date=date.isoformat() if date else None,
+                text=clip.text.decode(codec, 'replace'))
+
+
+def write_jsonl(clippings, out):
+    for clip in clippings:
+        out.write(json.dumps(to_dict(clip), ensure_ascii=False).encode('utf-8'))
+        out.write(b"\n")
+
+
+def write_csv(clippings, out):
+    writer = csv.writer(out)
+    writer.writerow(FIELDS)
+    for clip in clippings:
+        d = to_dict(clip)
+        writer.writerow([unicode(d[f]).encode('utf-8') if d[f] is not None else b""
+                         for f in FIELDS])
+
+
+def parse_date(s):
+    """
+    Parse a YYYY-MM-DD date.
+    :return: the epoch time at the start of the day
+    """
+    return timegm(datetime.strptime(s, "%Y-%m-%d").timetuple())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="kindle2okular.py query",
+                                     description="List and export clippings.")
+    parser.add_argument("-c", "--clippings", dest="clip_file", required=True, help="clippings file")
+    parser.add_argument("--title", type=_decode, help="books whose title contains this text")
+    parser.add_argument("--author", type=_decode, help="books whose author contains this text")
+    parser.add_argument("--since", type=parse_date, help="clippings added from this day, eg. 2014-04-17")
+    parser.add_argument("--until", type=parse_date, help="clippings added until this day, included")
+    parser.add_argument("--kind", choices=sorted(clippingparser.KIND_WORDS), help="type of clipping")
+    parser.add_argument("--books", default=False, action='store_const', const=True, help="list the books with their number of clippings")
+    parser.add_argument("--format", default="jsonl", choices=("jsonl", "csv"), help="output format (default: %(default)s)")
+    parser.add_argument("--cache-dir", dest="cache_dir", default=cache.CACHE_HOME, help="where to store the index (default: %(default)s)")
+    parser.add_argument("--no-cache", dest="cache_dir", action='store_const', const=None, help="don't store the index")
+    args = parser.parse_args(argv)
+
+    index = ClippingIndex(args.cache_dir)
+    clip_file = bytes(args.clip_file)
+    out = sys.stdout
+    if args.books:
+        for title_line, count, timestamp in index.books(clip_file):
+            date = datetime.utcfromtimestamp(timestamp).date() if timestamp else ""
+            out.write(("%6d  %-10s  %s\n" % (count, date, title_line)).encode('utf-8'))
+        return 0
+    # until is inclusive
+    until = args.until + 24 * 3600 if args.until else None
+    clippings = index.query(clip_file, title=args.title, author=args.author,
+                            since=args.since, until=until, kind=args.kind)
+    if args.format == "csv":
+        write_csv(clippings, out)
+    else:
+        write_jsonl(clippings, out)
+    return 0
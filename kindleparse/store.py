@@ -0,0 +1,394 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    A compact, read-only store of parsed clippings.
+
+    A dict of lists of Clipping costs over a hundred bytes per clip, so
+    holding the clippings of many users takes a lot of memory.
+    ClippingStore keeps them in a single buffer:
+
+     - titles, authors and kinds in a table of unique strings;
+     - the clippings of each title in a contiguous range of rows,
+       with titles sorted;
+     - kind, locations, page and timestamp in columns of uint32;
+     - texts concatenated, with a column of offsets.
+
+    The buffer is also the file format, so a saved store is memory
+    mapped back and read in place: nothing is parsed when loading.
+
+    A store is a mapping {'book title': [Clipping, ...]} like the one of
+    parse_clipping_records, and store.texts() is like parse_clippings,
+    so both work with find_clippings and TitleIndex.
+
+    Usage:
+
+        store = ClippingStore.parse("My Clippings.txt")
+        store.save("clippings.kcs")
+        store = ClippingStore.load("clippings.kcs")
+        title, clips = find_clippings("Altai", store)
+
+    Uses clippingparser and profiling
+"""
+from __future__ import unicode_literals, print_function
+from array import array
+from collections import defaultdict, Mapping, Sequence
+from mmap import mmap, ACCESS_READ
+from os import rename
+import struct
+import sys
+import clippingparser
+import profiling
+
+MAGIC = b"KCS1"
+# magic, number of strings, titles and clippings
+HEADER = struct.Struct(b"<4sIII")
+UINT = struct.Struct(b"<I")
+# the value of missing fields
+NONE = 0xffffffff
+COLUMNS = ('kind', 'start', 'end', 'page', 'timestamp')
+
+
+def _uint_array(values=()):
+    a = array(b'I', values)
+    assert a.itemsize == UINT.size
+    return a
+
+
+def _to_bytes(a):
+    if sys.byteorder != 'little':
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tostring()
+
+
+class StringTable(object):
+    """
+    Give a number to each unique string.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def add(self, s):
+        """
+        :param s: a string, or None
+        :return: the number of s, or NONE
+        """
+        if s is None:
+            return NONE
+        if isinstance(s, unicode):
+            s = s.encode(clippingparser.clippablepdf.CODEC)
+        if s not in self.ids:
+            self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return self.ids[s]
+
+
+class Packer(object):
+    """
+    Collect clippings in columns, then serialize them in the format
+    of ClippingStore. Texts are appended to a single buffer, so that
+    parsing doesn't create a python object per clip.
+    """
+
+    def __init__(self):
+        self.strings = StringTable()
+        # the rows of every title line
+        self.rows = defaultdict(_uint_array)
+        self.columns = [_uint_array() for _ in COLUMNS]
+        self.text_data, self.text_offsets = bytearray(), _uint_array([0])
+
+    def add_row(self, title_line, text, kind=None, start=None, end=None,
+                page=None, timestamp=None):
+        self.rows[title_line].append(len(self.text_offsets) - 1)
+        self.columns[0].append(self.strings.add(kind))
+        for column, value in zip(self.columns[1:], (start, end, page, timestamp)):
+            column.append(NONE if value is None else value)
+        self.text_data += text
+        self.text_offsets.append(len(self.text_data))
+
+    def add(self, title_line, clip):
+        """
+        :param clip: a Clipping or a text
+        """
+        if isinstance(clip, bytes):
+            self.add_row(title_line, clip)
+        else:
+            self.add_row(title_line, clip.text, clip.kind, clip.start, clip.end,
+                         clip.page, clip.timestamp)
+
+    def add_entry(self, title_line, notes, text):
+        """
+        Add an entry of clippingparser.iter_clippings.
+        """
+        self.add_row(title_line, text, *clippingparser.parse_metadata(notes))
+
+    def pack(self):
+        """
+        Serialize the clippings, emptying the packer.
+        :return: an anonymous memory map, where the clippings of every
+            title are sorted by position like in parse_clipping_records
+        """
+        strings, columns, offsets = self.strings, self.columns, self.text_offsets
+        starts = columns[1]
+        titles = sorted(self.rows)
+        title_ids, first = _uint_array(), _uint_array([0])
+        sorted_columns = [_uint_array() for _ in COLUMNS]
+        text_offsets, order = _uint_array([0]), _uint_array()
+        for title_line in titles:
+            _, author = clippingparser.split_title(title_line)
+            title_ids.extend((strings.add(title_line), strings.add(author)))
+            rows = sorted(self.rows[title_line],
+                          key=lambda i: -1 if starts[i] == NONE else starts[i])
+            for i in rows:
+                for column, sorted_column in zip(columns, sorted_columns):
+                    sorted_column.append(column[i])
+                text_offsets.append(text_offsets[-1] + offsets[i + 1] - offsets[i])
+            order.extend(rows)
+            first.append(len(order))
+        string_offsets = _uint_array([0])
+        for s in strings.strings:
+            string_offsets.append(string_offsets[-1] + len(s))
+        sections = [string_offsets, title_ids, first] + sorted_columns + [text_offsets]
+        head = b"".join(
+            [HEADER.pack(MAGIC, len(strings.strings), len(titles), len(order))] +
+            [_to_bytes(a) for a in sections] + strings.strings)
+        # write in place, as copying the texts twice doubles the peak memory
+        out = mmap(-1, len(head) + text_offsets[-1])
+        out.write(head)
+        for i in order:
+            out.write(buffer(self.text_data, offsets[i], offsets[i + 1] - offsets[i]))
+        self.__init__()
+        return out
+
+
+def pack(records):
+    """
+    Serialize clippings in the format of ClippingStore.
+    :param records: a dict of the form {'book title': [Clipping, ...]},
+        or {'book title': ['clip1', ...]} as returned by parse_clippings
+    :return: an anonymous memory map, see Packer.pack
+    """
+    packer = Packer()
+    for title_line, clips in records.items():
+        for clip in clips:
+            packer.add(title_line, clip)
+    return packer.pack()
+
+
+class ClippingList(Sequence):
+    """
+    The clippings of a title, read from a ClippingStore.
+    """
+
+    def __init__(self, store, title_line, first, last, texts=False):
+        self.store = store
+        self.title_line = title_line
+        self.first, self.last = first, last
+        self.texts = texts
+
+    def __len__(self):
+        return self.last - self.first
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        if self.texts:
+            return self.store.text(self.first + i)
+        return self.store.clipping(self.first + i, self.title_line)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class ClippingStore(Mapping):
+    """
+    A read-only mapping {'book title': [Clipping, ...]} backed by
+    a buffer in the format written by pack.
+    """
+
+    def __init__(self, buf, path=None):
+        """
+        :param buf: a byte string or a memory map
+        :param path: the file mapped by buf, if any
+        """
+        if len(buf) < HEADER.size:
+            raise ValueError("Not a clipping store")
+        magic, self.num_strings, self.num_titles, self.num_clippings = \
+            HEADER.unpack_from(buf)
+        if magic != MAGIC:
+            raise ValueError("Not a clipping store")
+        self.buf, self.path = buf, path
+        self.sections = {}
+        offset = HEADER.size
+        for name, count in ([('string_offsets', self.num_strings + 1),
+                             ('titles', 2 * self.num_titles),
+                             ('first', self.num_titles + 1)] +
+                            [(c, self.num_clippings) for c in COLUMNS] +
+                            [('text_offsets', self.num_clippings + 1)]):
+            self.sections[name] = offset
+            offset += count * UINT.size
+        self.string_data = offset
+        if len(buf) < offset:
+            raise ValueError("Truncated clipping store")
+        self.text_data = offset + self._uint('string_offsets', self.num_strings)
+        if len(buf) < self.text_data + self._uint('text_offsets', self.num_clippings):
+            raise ValueError("Truncated clipping store")
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        :param records: see pack
+        """
+        return cls(pack(records))
+
+    @classmethod
+    def parse(cls, clippings_path):
+        """
+        Parse a Kindle My Clippings.txt file into a store, without
+        creating a Clipping per entry.
+        """
+        packer = Packer()
+        with profiling.stage("parse_clippings"):
+            for _, title_line, notes, text in clippingparser.iter_clippings(clippings_path):
+                packer.add_entry(title_line, notes, text)
+            return cls(packer.pack())
+
+    @classmethod
+    def load(cls, path):
+        """
+        Map a file written by save.
+        """
+        with open(path, 'rb') as fh:
+            try:
+                buf = mmap(fh.fileno(), 0, access=ACCESS_READ)
+            except ValueError:
+                raise ValueError("Not a clipping store: %r" % path)
+        return cls(buf, path)
+
+    def save(self, path):
+        tmp = path + b".tmp"
+        with open(tmp, 'wb') as fh:
+            fh.write(self.buf[:])
+        rename(tmp, path)
+
+    def close(self):
+        if isinstance(self.buf, mmap):
+            self.buf.close()
+
+    def __reduce__(self):
+        # worker processes map the file again instead of copying it
+        if self.path:
+            return _load, (self.path, )
+        return ClippingStore, (self.buf[:], )
+
+    def _uint(self, section, i):
+        return UINT.unpack_from(self.buf, self.sections[section] + i * UINT.size)[0]
+
+    def _field(self, section, i):
+        value = self._uint(section, i)
+        return None if value == NONE else value
+
+    def string(self, sid):
+        """
+        :return: the string numbered sid, as bytes
+        """
+        if sid == NONE:
+            return None
+        start = self.string_data + self._uint('string_offsets', sid)
+        return self.buf[start:self.string_data + self._uint('string_offsets', sid + 1)]
+
+    def _decoded(self, sid):
+        s = self.string(sid)
+        return s if s is None else s.decode(clippingparser.clippablepdf.CODEC)
+
+    def title(self, k):
+        return self.string(self._uint('titles', 2 * k))
+
+    def find_title(self, title_line):
+        """
+        Binary search a title line.
+        :return: its number, or None
+        """
+        lo, hi = 0, self.num_titles
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.title(mid) < title_line:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_titles and self.title(lo) == title_line:
+            return lo
+        return None
+
+    def author(self, title_line):
+        k = self.find_title(title_line)
+        if k is None:
+            raise KeyError(title_line)
+        return self._decoded(self._uint('titles', 2 * k + 1))
+
+    def text(self, i):
+        start = self.text_data + self._uint('text_offsets', i)
+        return self.buf[start:self.text_data + self._uint('text_offsets', i + 1)]
+
+    def clipping(self, i, title_line):
+        return clippingparser.Clipping(
+            title_line, self.text(i), self._decoded(self._uint('kind', i)),
+            *[self._field(c, i) for c in COLUMNS[1:]])
+
+    def clippings(self, title_line, texts=False):
+        k = self.find_title(title_line)
+        if k is None:
+            raise KeyError(title_line)
+        return ClippingList(self, title_line, self._uint('first', k),
+                            self._uint('first', k + 1), texts)
+
+    def __getitem__(self, title_line):
+        return self.clippings(title_line)
+
+    def __iter__(self):
+        for k in xrange(self.num_titles):
+            yield self.title(k)
+
+    def __len__(self):
+        return self.num_titles
+
+    def texts(self):
+        """
+        :return: a mapping {'book title': ['clip1', ...]} like the
+            one of parse_clippings
+        """
+        return TextView(self)
+
+
+def _load(path):
+    return ClippingStore.load(path)
+
+
+class TextView(Mapping):
+    """
+    The texts of the clippings in a ClippingStore.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, title_line):
+        return self.store.clippings(title_line, texts=True)
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self):
+        return len(self.store)
@@ -0,0 +1,184 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+    Keep the annotations of a PDF library in sync with the Kindle.
+
+    LibraryWatcher polls My Clippings.txt and the library: new entries
+    are parsed from the offset where the previous poll stopped, and
+    only the books whose clippings changed, or the new and modified
+    pdf files, are annotated again. Annotation files are merged, so
+    only the new clippings are searched.
+
+    Usage:
+
+        # python kindle2okular.py --watch -c /media/kindle/documents/My\ Clippings.txt ~/books
+
+    Uses clippingparser, batch and query
+"""
+from __future__ import unicode_literals, print_function
+from collections import defaultdict
+from os import stat
+from os.path import getsize
+from time import sleep
+import clippingparser
+import batch
+import query
+import cache
+
+# seconds between two polls
+POLL_INTERVAL = 2.0
+
+
+def file_state(path):
+    """
+    :return: a couple (size, mtime), or None if path doesn't exist
+    """
+    try:
+        st = stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime
+
+
+class ClippingsFeed(object):
+    """
+    The clippings of a My Clippings.txt file, parsed incrementally.
+    """
+
+    def __init__(self, clippings_path):
+        self.path = clippings_path
+        self.records = defaultdict(list)
+        self.index = clippingparser.TitleIndex(self.records)
+        self.offset = 0
+        # the query.checkpoint of the file at the offset
+        self.check = None
+
+    def reset(self):
+        self.records.clear()
+        self.index = clippingparser.TitleIndex(self.records)
+        self.offset = 0
+        self.check = None
+
+    def rewritten(self):
+        """
+        :return: True if the file was not only appended to since the
+            last update
+        """
+        return (getsize(self.path) < self.offset or
+                query.checkpoint(self.path, self.offset) != self.check)
+
+    def update(self):
+        """
+        Parse the entries added since the last update. If the file
+        was not only appended to, it is parsed again.
+        If the file can't be read, the feed is emptied, so that the
+        next update parses it again.
+        :return: the set of title lines with new clippings
+        """
+        try:
+            if self.offset and self.rewritten():
+                self.reset()
+            counts = dict((t, len(v)) for t, v in self.records.items())
+            self.offset = clippingparser.update_clipping_records(
+                self.records, self.path, self.offset)
+            self.check = query.checkpoint(self.path, self.offset)
+        except (IOError, OSError):
+            self.reset()
+            raise
+        changed = set(t for t, v in self.records.items() if len(v) != counts.get(t))
+        for title_line in changed:
+            if title_line not in counts:
+                self.index.add(title_line)
+        return changed
+
+
+class LibraryWatcher(object):
+    """
+    Annotate the books of a library when their clippings or files change.
+
+    A file is read only when it didn't change since the previous poll,
+    so that files being written by the Kindle or copied in the library
+    are never read halfway.
+    """
+
+    def __init__(self, clippings_path, library, jobs=1, cache_dir=cache.CACHE_HOME,
+                 cache_size=None, max_memory=None, prefilter=True, inline=False):
+        """
+        :param clippings_path: the My Clippings.txt file
+        :param library: pdf files, directories or manifests, see find_books
+        The other parameters are the ones of process_library.
+        """
+        self.feed = ClippingsFeed(clippings_path)
+        self.library = library
+        self.options = dict(jobs=jobs, cache_dir=cache_dir, cache_size=cache_size,
+                            max_memory=max_memory, prefilter=prefilter, inline=inline)
+        # the state of every file at the previous poll
+        self.seen = {}
+        # the state of the files already processed
+        self.done = {}
+        # the title line of the clippings of each book, None if not found
+        self.titles = {}
+
+    def settled(self, path):
+        """
+        :return: the state of a file if it didn't change since the
+            previous poll, else None
+        """
+        state = file_state(path)
+        previous, self.seen[path] = self.seen.get(path), state
+        return state if state == previous else None
+
+    def changes(self):
+        """
+        Parse the new clippings and list the books to annotate.
+        :return: a list of pdf files
+        """
+        changed, added = set(), False
+        state = self.settled(self.feed.path)
+        if state and state != self.done.get(self.feed.path):
+            known = set(self.feed.records)
+            try:
+                changed = self.feed.update()
+            except (IOError, OSError) as e:
+                print("Can't read the clippings: %s" % e)
+                return []
+            added = bool(changed - known)
+            self.done[self.feed.path] = state
+        try:
+            books = batch.find_books(self.library)
+        except (IOError, OSError) as e:
+            print("Can't list the library: %s" % e)
+            return []
+        queue = []
+        for pdf_file in books:
+            state = self.settled(pdf_file)
+            if not state:
+                continue
+            title = self.titles.get(pdf_file)
+            if (state != self.done.get(pdf_file) or title in changed or
+                    (title is None and added)):
+                queue.append(pdf_file)
+                self.done[pdf_file] = state
+        return queue
+
+    def poll(self):
+        """
+        Annotate the changed books.
+        :return: a list of BookSummary
+        """
+        queue = self.changes()
+        if not queue:
+            return []
+        summaries = batch.process_library(queue, self.feed.records, merge=True,
+                                          index=self.feed.index, **self.options)
+        for summary in summaries:
+            self.titles[summary.pdf_file] = summary.title
+        return summaries
+
+    def run(self, interval=POLL_INTERVAL):
+        """
+        Poll forever.
+        """
+        while True:
+            self.poll()
+            sleep(interval)
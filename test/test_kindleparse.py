@@ -1,12 +1,16 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, print_function
-from xml.etree.ElementTree import tostring, parse
+from xml.etree.ElementTree import tostring, parse, fromstring as parse_xml_string
+from contextlib import contextmanager
+import os
 import pdfquery
 import re
+import shutil
+import tempfile
 
 from pyPdf import PdfFileReader
-from nose.tools import assert_equal, assert_in, assert_true
+from nose.tools import assert_equal, assert_in, assert_true, assert_almost_equal, assert_raises
 
 from kindleparse import ClippablePDF, CODEC as pdf_parser_codec, parse_clippings
 from kindleparse import clippingparser
@@ -32,8 +36,22 @@ EXPECTED_CLIP_IN_PAGE = [
 test_context = {}
 
 
+@contextmanager
+def temp_dir():
+    """
+    A temporary directory, removed with its content on exit.
+    """
+    path = tempfile.mkdtemp()
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path)
+
+
 pdf = ClippablePDF(book_file)
 pdf.pdf_query.load()
+
+
 #
 # Parse Clippings and PDF
 #
@@ -44,6 +62,152 @@ def test_parse_clippings():
     assert len(clippings) == 3
 
 
+def test_iter_clippings_resume():
+    entries = list(clippingparser.iter_clippings(clippings_file, chunk_size=64))
+    assert_equal(7, len(entries))
+    # resuming from an offset skips the entries before it
+    offset = entries[3][0]
+    tail = list(clippingparser.iter_clippings(clippings_file, offset))
+    assert_equal(entries[4:], tail)
+
+
+def test_iter_clippings_truncated():
+    with open(clippings_file, 'rb') as fh:
+        data = fh.read()
+    fd, tmp = tempfile.mkstemp(suffix=".txt")
+    try:
+        # the Kindle is still writing the last entry
+        os.write(fd, data[:-20])
+        os.close(fd)
+        entries = list(clippingparser.iter_clippings(tmp))
+        assert_equal(6, len(entries))
+        offset = entries[-1][0]
+        assert_equal(data.rindex(b"Altai"), offset)
+        with open(tmp, 'wb') as fh:
+            fh.write(data)
+        tail = list(clippingparser.iter_clippings(tmp, offset))
+        assert_equal([b"Vienna"], [text for _, _, _, text in tail])
+        assert_equal(len(data), tail[-1][0])
+    finally:
+        os.unlink(tmp)
+
+
+def test_update_clippings_append_only():
+    from collections import defaultdict
+    fd, tmp = tempfile.mkstemp(suffix=".txt")
+    os.close(fd)
+    with open(clippings_file, 'rb') as fh:
+        data = fh.read()
+    head, tail = data[:data.index(b"JBoss")], data
+    try:
+        with open(tmp, 'wb') as fh:
+            fh.write(head)
+        clippings = defaultdict(list)
+        offset = clippingparser.update_clippings(clippings, tmp)
+        assert_equal(len(head), offset)
+        assert_equal(1, len(clippings))
+        shutil.copy(clippings_file, tmp)
+        offset = clippingparser.update_clippings(clippings, tmp, offset)
+        assert_equal(len(tail), offset)
+        assert_equal(parse_clippings(clippings_file), clippings)
+    finally:
+        os.unlink(tmp)
+
+
+def test_query_clipping_index():
+    from kindleparse import query
+    fd, tmp = tempfile.mkstemp(suffix=".txt")
+    os.close(fd)
+    with open(clippings_file, 'rb') as fh:
+        data = fh.read()
+    head = data[:data.index(b"JBoss")]
+    index = query.ClippingIndex(None)
+    try:
+        with open(tmp, 'wb') as fh:
+            fh.write(head)
+        assert_equal(5, index.refresh(tmp))
+        with open(tmp, 'wb') as fh:
+            fh.write(data)
+        # only the appended entries are parsed
+        assert_equal(2, index.refresh(tmp))
+        assert_equal(0, index.refresh(tmp))
+        books = index.books(tmp)
+        assert_equal([(amazon_title, 5)], [b[:2] for b in books if b[1] > 1])
+        clips = list(index.query(tmp, author="BARON", kind=clippingparser.HIGHLIGHT))
+        assert_equal(sorted(parse_clippings(tmp)[amazon_title]),
+                     sorted(c.text for c in clips))
+        last = max(c.timestamp for c in clips)
+        assert_equal([c.text for c in clips if c.timestamp == last],
+                     [c.text for c in index.query(tmp, author="baron", since=last)])
+        assert_equal([], list(index.query(tmp, author="baron", since=last + 1)))
+        assert_equal("High Performance MySQL, Third Edition", query.to_dict(clips[0])['title'])
+    finally:
+        os.unlink(tmp)
+
+
+def test_query_clipping_index_rewrite():
+    from kindleparse import query
+    with open(clippings_file, 'rb') as fh:
+        data = fh.read()
+    entries = len(list(clippingparser.iter_clippings(clippings_file)))
+    # the middle of the file is past the first HEAD_SIZE bytes
+    data = data * 8
+    fd, tmp = tempfile.mkstemp(suffix=".txt")
+    os.close(fd)
+    index = query.ClippingIndex(None)
+    try:
+        with open(tmp, 'wb') as fh:
+            fh.write(data)
+        assert_equal(8 * entries, index.refresh(tmp))
+        # an entry in the middle is removed, then new ones are appended
+        start = data.index(b"Altai", 4 * len(data) // 8)
+        start = data.rindex(b"==========\r\n", 0, start) + 12
+        end = data.index(b"==========\r\n", start) + 12
+        with open(tmp, 'wb') as fh:
+            fh.write(data[:start] + data[end:] + data[:len(data) // 8])
+        assert_equal(9 * entries - 1, index.refresh(tmp))
+        assert_equal(8, len(list(index.query(tmp, title="Altai"))))
+    finally:
+        os.unlink(tmp)
+
+
+def test_parse_metadata():
+    expected = [
+        ("-  La tua evidenziazione alla posizione 461-461 | "
+         "Aggiunto in data giovedì 17 aprile 2014 12:11:32",
+         ('highlight', 461, 461, None, 1397736692)),
+        ("- Your Highlight on page 12 | Location 461-62 | "
+         "Added on Thursday, April 17, 2014 12:11:32 PM",
+         ('highlight', 461, 462, 12, 1397736692)),
+        ("- Your Note on Location 470 | Added on Thursday, April 17, 2014 1:05 AM",
+         ('note', 470, 470, None, 1397696700)),
+        ("- Il tuo segnalibro alla posizione 12 | "
+         "Aggiunto in data lunedì 3 marzo 2014 08:00:00",
+         ('bookmark', 12, 12, None, 1393833600)),
+    ]
+    for line, fields in expected:
+        yield assert_equal, fields, clippingparser.parse_metadata(line.encode(pdf_parser_codec))
+
+
+def test_parse_clipping_records():
+    records = clippingparser.parse_clipping_records(clippings_file)
+    clips = records[amazon_title.encode(pdf_parser_codec)]
+    assert_equal([46, 46, 46, 48, 48], [c.start for c in clips])
+    assert_equal(set(['highlight']), set(c.kind for c in clips))
+    assert_equal('Baron Schwartz', clips[0].author)
+    assert_equal(2014, clips[0].date.year)
+    assert_equal(b'oreilly.com', clips[0].text)
+
+
+def test_parse_clippings_sorted_like_records():
+    records = clippingparser.parse_clipping_records(clippings_file)
+    assert_equal(dict((t, [c.text for c in clips]) for t, clips in records.items()),
+                 parse_clippings(clippings_file))
+    line = "- Your Highlight on page 12 | Location 461-62 | Added on Thursday"
+    assert_equal(461, clippingparser.parse_location(line))
+    assert_equal(None, clippingparser.parse_location("- Your Bookmark on page 3"))
+
+
 def test_get_book_title():
     book_title = pdf.get_title()
     assert book_title == PDF_TITLE
@@ -54,6 +218,75 @@ def test_get_clippings_title_for_book():
     title, _ = clippingparser.find_clippings(PDF_TITLE, clippings)
     assert_equal(amazon_title, title)
 
+
+def test_title_index_lookup():
+    clippings = clippingparser.parse_clippings(clippings_file)
+    index = clippingparser.TitleIndex(clippings)
+    ranked = index.lookup('High Performance MySQL')
+    assert_equal(1, len(ranked))
+    assert_equal((1.0, amazon_title), ranked[0])
+    # the author is not part of the title
+    assert_equal((None, []), index.find('Wu Ming'))
+    assert_equal((None, []), index.find('Programming Erlang'))
+    title, clips = clippingparser.find_clippings('altai', clippings, index)
+    assert_equal(b'Altai (Wu Ming)', title)
+    assert_equal([b'Vienna'], clips)
+
+
+def test_clipping_store():
+    import pickle
+    from kindleparse import ClippingStore
+    records = clippingparser.parse_clipping_records(clippings_file)
+    fd, tmp = tempfile.mkstemp(suffix=b".kcs")
+    os.close(fd)
+    store = None
+    try:
+        ClippingStore.from_records(records).save(tmp)
+        store = ClippingStore.load(tmp)
+        assert_equal(sorted(records), list(store))
+        assert_equal(parse_clippings(clippings_file), store.texts())
+        clips = store[amazon_title.encode(pdf_parser_codec)]
+        expected = records[amazon_title.encode(pdf_parser_codec)]
+        assert_equal([(c.title, c.text, c.kind, c.start, c.end, c.page, c.timestamp)
+                      for c in expected],
+                     [(c.title, c.text, c.kind, c.start, c.end, c.page, c.timestamp)
+                      for c in clips])
+        assert_equal('Baron Schwartz', store.author(clips[-1].title))
+        assert_true(b"missing" not in store)
+        # the existing lookups work on the store
+        title, texts = clippingparser.find_clippings(PDF_TITLE, store.texts())
+        assert_equal(amazon_title, title)
+        assert_equal([c.text for c in expected], texts)
+        title, clips = clippingparser.TitleIndex(pickle.loads(pickle.dumps(store))).find('altai')
+        assert_equal((b'Altai (Wu Ming)', b'Vienna'), (title, clips[0].text))
+        # plain texts can be stored too
+        texts = ClippingStore.from_records(parse_clippings(clippings_file)).texts()
+        assert_equal(parse_clippings(clippings_file), texts)
+    finally:
+        if store is not None:
+            store.close()
+        os.unlink(tmp)
+
+
+def test_clipping_store_parse():
+    import sys
+    from kindleparse import ClippingStore
+
+    def fields(clips):
+        return [(c.title, c.text, c.kind, c.start, c.end, c.page, c.timestamp)
+                for c in clips]
+    records = clippingparser.parse_clipping_records(clippings_file)
+    store = ClippingStore.parse(clippings_file)
+    assert_equal(sorted(records), list(store))
+    for title_line, clips in records.items():
+        assert_equal(fields(clips), fields(store[title_line]))
+    # the store takes less memory than the bare texts
+    texts = parse_clippings(clippings_file)
+    lean = sum(sys.getsizeof(clips) + sum(sys.getsizeof(t) for t in clips)
+               for clips in texts.values())
+    assert_true(len(store.buf) < lean, (len(store.buf), lean))
+
+
 #
 # Find clippings in pdf files
 #
@@ -71,6 +304,49 @@ def test_pdf_to_text_extract():
         yield assert_in, needle, pages[item_no].decode(pdf_parser_codec)
 
 
+def test_pdf_to_text_parallel():
+    expected = list(pdf.pdf_to_text())
+    assert_equal(expected, list(pdf.pdf_to_text(jobs=3)))
+    assert_equal(expected[:5], list(pdf.pdf_to_text(5, jobs=2)))
+
+
+def test_pdf_document_is_shared():
+    from kindleparse import clippablepdf
+    with open(book_file, 'rb') as fh:
+        assert_equal(PdfFileReader(fh).getNumPages(), pdf.num_pages)
+    assert_true(pdf.document is pdf.pdf_query.doc)
+    # a new parse of the file gives the same text
+    assert_equal(list(pdf.pdf_to_text(3)),
+                 list(clippablepdf.iter_page_text(book_file, maxpages=3)))
+    assert_equal(list(pdf.pdf_to_text())[4:6],
+                 list(clippablepdf.iter_page_text(book_file, pagenos={4, 5})))
+
+
+def test_clippable_pdf_close():
+    with ClippablePDF(book_file) as other:
+        fp = other.pdf_query.file
+        assert_equal(pdf.get_title(), other.get_title())
+    assert_raises(ValueError, fp.read, 1)
+
+
+def test_iter_page_text_stops_after_last_page():
+    from pdfminer.pdfpage import PDFPage
+    from kindleparse import clippablepdf
+    walked = []
+    create_pages = PDFPage.__dict__['create_pages']
+
+    def logged_create_pages(cls, document):
+        for n, page in enumerate(create_pages.__get__(None, cls)(document)):
+            walked.append(n)
+            yield page
+    PDFPage.create_pages = classmethod(logged_create_pages)
+    try:
+        assert_equal(2, len(list(clippablepdf.iter_page_text(book_file, pagenos={4, 5}))))
+    finally:
+        PDFPage.create_pages = create_pages
+    assert_equal(range(6), walked)
+
+
 def test_pdf_to_text_in_page():
     pages = list(pdf.pdf_to_text())
     for page, needle in EXPECTED_CLIP_IN_PAGE:
@@ -89,6 +365,202 @@ def test_pdf_to_text_in_book():
         yield assert_equal, ep+1, pgnos.pop(0)
 
 
+def test_automaton_search():
+    from kindleparse.matcher import Automaton
+    automaton = Automaton([(0, 'he'), (1, 'she'), (2, 'his'), (3, 'hers'), (4, 'he')])
+    found = sorted(automaton.search('ushers'))
+    assert_equal([(4, 0), (4, 1), (4, 4), (6, 3)], found)
+
+
+def test_page_matcher_scan():
+    from kindleparse.matcher import PageMatcher
+    pages = list(pdf.pdf_to_text())
+    pgnos, clippings = zip(*EXPECTED_CLIP_IN_PAGE)
+    hits = PageMatcher(clippings).scan(pages)
+    for pgno, pages_found in zip(pgnos, hits):
+        yield assert_in, pgno - 1, pages_found
+
+
+def test_cleanup_for_match_folding():
+    text = "The \ufb01rst transac-\ntion\u2019s \u201cdata\u201d \u2014 soft\xad\nhyphen\xa0!"
+    assert_equal("the first transaction's \"data\" - softhyphen !",
+                 clippingparser.cleanup_for_match(text))
+
+
+def test_fuzzy_best_match():
+    from kindleparse import fuzzy
+    assert_equal((0, 16), fuzzy.best_match("row locks", "use of row locks."))
+    assert_equal((1, 15), fuzzy.best_match("row locks", "use of rowlocks."))
+    assert_equal(None, fuzzy.best_match("row locks", "table locks", k=1))
+    text = "x" * 1000 + "the use of row-level locks" + "x" * 1000
+    assert_equal((1, 1025), fuzzy.find("the use of row level lock", text, 2))
+    assert_equal(None, fuzzy.find("the use of table locking", text, 2))
+
+
+def test_page_matcher_approximate():
+    from kindleparse.matcher import PageMatcher
+    pages = list(pdf.pdf_to_text())
+    clip = EXPECTED_CLIP_IN_PAGE[3][1]
+    typo = clip.replace("The locking style", "The lockng stlye")
+    matcher = PageMatcher([clip, typo, b"not in this book at all, really"])
+    hits = matcher.scan(pages)
+    assert_equal([[18], [18], []], hits)
+    assert_equal(1.0, matcher.scores[0])
+    assert_true(0.9 < matcher.scores[1] < 1.0)
+    assert_equal([[]], PageMatcher([typo], approximate=False).scan(pages))
+
+
+def test_page_matcher_rejects_prefix_only():
+    from kindleparse.matcher import PageMatcher
+    pages = list(pdf.pdf_to_text())
+    # shares "The locking style" with the clip of page 19
+    clip = b"The locking style of my grandmother's house has nothing to do with databases at all"
+    assert_equal([[]], PageMatcher([clip]).scan(pages))
+    assert_true(not clippingparser.find_clipping_in_page(clip, pages[18]))
+    report = clippingparser.match_clippings_in_text([clip], pages)
+    assert_equal(([], [(0, clip)]), (report.found, report.missed))
+
+
+def test_match_clippings_in_text_keep_going():
+    pgnos, clippings = zip(*EXPECTED_CLIP_IN_PAGE)
+    # a missing clip and a clip found only after the next ones
+    clippings = list(clippings)
+    clippings[1:1] = [b'not in this book', clippings[-1]]
+    pages = list(pdf.pdf_to_text())
+    report = clippingparser.match_clippings_in_text(clippings, pages)
+    assert_equal([p - 1 for p in pgnos], [p for p, _ in report.found])
+    assert_equal([1, 2], [n for n, _ in report.missed])
+    found = clippingparser.search_clippings_in_text(clippings, pages, strict=False)
+    assert_equal(report.found, list(found))
+
+
+def test_pending_clippings():
+    # duplicate texts are different clips
+    pending = clippingparser.PendingClippings([b"a", b"b", b"a"])
+    for state in pending:
+        if state.n:
+            pending.place(state.n, page=state.n * 10)
+        else:
+            pending.miss(state.n)
+    assert_equal(1, len(pending))
+    assert_equal([b"a"], pending.clippings())
+    assert_equal("placed 2 of 3 clippings", pending.progress())
+    report = pending.report()
+    assert_equal([(10, b"b"), (20, b"a")], report.found)
+    assert_equal([(0, b"a")], report.missed)
+    assert_equal([1, 1, 1], [s.attempts for s in pending.states])
+
+
+def test_location_model():
+    from kindleparse.calibration import LocationModel, ModelStore
+    model = LocationModel(100)
+    model.add(100, 10)
+    assert_equal(None, model.window(150))
+    # (300, 5) is a wrong match, out of the monotone sequence
+    for loc, page in [(300, 5), (200, 20), (400, 40)]:
+        model.add(loc, page)
+    assert_equal([(100, 10), (200, 20), (400, 40)], model.knots)
+    assert_equal((30, 20), model.predict(300))
+    assert_equal(range(23, 38), model.window(300))
+    # extrapolate with the mean slope, clamping to the book pages
+    assert_equal(range(79, 100), model.window(950))
+    with temp_dir() as cache_dir:
+        store = ModelStore(cache_dir)
+        assert_equal([], store.load(book_file, 19).points)
+        store.save(book_file, model)
+        assert_equal(model.points, store.load(book_file, 19).points)
+
+
+def test_scan_clippings_with_model():
+    from kindleparse.calibration import LocationModel, scan_clippings
+    from kindleparse.matcher import PageMatcher
+    pages = list(pdf.pdf_to_text())
+    pgnos, texts = zip(*EXPECTED_CLIP_IN_PAGE)
+    clippings = [clippingparser.Clipping(amazon_title, text, start=(p - 1) * 10)
+                 for p, text in EXPECTED_CLIP_IN_PAGE]
+    # more clips than the calibration sample
+    clippings = [clippingparser.Clipping(amazon_title, clip.text, start=clip.start + i)
+                 for clip in clippings for i in range(3)]
+    pgnos = [p for p in pgnos for _ in range(3)]
+    searched = []
+
+    class Pages(list):
+        def __getitem__(self, i):
+            searched.append(i)
+            return list.__getitem__(self, i)
+
+        def __iter__(self):
+            for i in range(len(self)):
+                yield self[i]
+    # a new model is calibrated while reading every page once
+    model = LocationModel(len(pages))
+    hits = scan_clippings(clippings, Pages(pages), model)
+    assert_equal(PageMatcher(clippings).scan(pages), hits)
+    assert_equal(range(len(pages)), searched)
+    assert_true(model.ready())
+    # a calibrated model searches only the predicted pages
+    del searched[:]
+    hits = scan_clippings(clippings, Pages(pages), model)
+    assert_equal([[p - 1] for p in pgnos], hits)
+    assert_true(set(searched) < set(range(len(pages))))
+
+def test_longest_page_sequence():
+    hits = [[0, 9], [1], [], [8], [2, 3], [3]]
+    assert_equal(set([0, 1, 4, 5]), clippingparser.longest_page_sequence(hits))
+
+
+def test_text_pages_cache():
+    with temp_dir() as cache_dir:
+        cached_pdf = ClippablePDF(book_file, cache_dir=cache_dir)
+        expected = list(pdf.pdf_to_text())
+        assert_equal(expected, list(cached_pdf.text_pages()))
+        # reruns don't interpret the pdf
+        cached_pdf = ClippablePDF(book_file, cache_dir=cache_dir)
+        cached_pdf.pdf_to_text = None
+        pages = cached_pdf.text_pages()
+        assert_equal(len(expected), len(pages))
+        assert_equal(expected[18], pages[18])
+        assert_equal(expected[-1], pages[-1])
+        assert_equal(expected[2:5], list(pages[2:5]))
+        assert_equal(expected, list(pages))
+
+
+def test_layout_tree_cache():
+    from kindleparse.cache import LayoutTreeCache
+    with temp_dir() as cache_dir:
+        cached_pdf = ClippablePDF(book_file, cache_dir=cache_dir)
+        cached_pdf.pdf_query.load(17, 18)
+        expected = cached_pdf.get_clipping_position(EXPECTED_CLIP_IN_PAGE[3][1])
+        assert_true(expected)
+        # the second time, the tree is loaded from the cache
+        cached_pdf = ClippablePDF(book_file, cache_dir=cache_dir)
+        cached_pdf.pdf_query.get_layout = None
+        cached_pdf.pdf_query.load(17, 18)
+        assert_equal(expected, cached_pdf.get_clipping_position(EXPECTED_CLIP_IN_PAGE[3][1]))
+        # trees are cached per page, so other page ranges hit the cache
+        cached_pdf.pdf_query.load(18)
+        assert_equal(['18'], cached_pdf.pdf_query.tree.xpath('//LTPage/@page_index'))
+        assert_equal(expected, cached_pdf.get_clipping_position(EXPECTED_CLIP_IN_PAGE[3][1]))
+        # and only the missing pages are parsed
+        parsed = []
+        cached_pdf = ClippablePDF(book_file, cache_dir=cache_dir)
+        get_layout = cached_pdf.pdf_query.get_layout
+
+        def logged_get_layout(page):
+            parsed.append(page)
+            return get_layout(page)
+        cached_pdf.pdf_query.get_layout = logged_get_layout
+        cached_pdf.load(16, 18)
+        assert_equal(1, len(parsed))
+        assert_equal(['16', '18'], cached_pdf.pdf_query.tree.xpath('//LTPage/@page_index'))
+        # eviction keeps the most recently used entries
+        layout_cache = LayoutTreeCache(cache_dir, max_size=1)
+        layout_cache.hash_key = 'x'
+        layout_cache.set("16_18", cached_pdf.pdf_query.tree)
+        assert_equal(["x_16.xml.gz", "x_18.xml.gz"],
+                     sorted(os.listdir(layout_cache.directory)))
+
+
 def test_get_clipping_position_in_page_single():
     from kindleparse import okularwriter
     expected_clip_in_page = [
@@ -107,10 +579,96 @@ def test_get_clipping_position_in_page_single():
         assert_in("quad", ret)
 
 
+def test_layout_index_find_multiline():
+    from kindleparse.layoutindex import LayoutIndex
+    index = LayoutIndex(pdf.pdf_query.tree)
+    lines = index.find(EXPECTED_CLIP_IN_PAGE[2][1])
+    assert_equal(3, len(lines))
+    assert_equal(set([17]), set(l.page_index for l in lines))
+    assert_equal(sorted(lines, key=lambda l: -l.y0), lines)
+    # a short prefix is not enough
+    assert_equal([], index.find("follows. Read locks on a bookshelf"))
+    # but a few errors are tolerated
+    assert_equal(lines[:1], index.find("follows. Read locks on a resourse are shred, or mutually"))
+    assert_equal([], index.find(""))
+
+
+def test_layout_index_joins_like_cleanup():
+    from lxml import etree
+    from kindleparse.layoutindex import LayoutIndex
+    raw = ["are exclusive\u2014", "i.e., they block transac-", "tion and soft\xad",
+           "hyphen words - ", "but not dashes"]
+    page = etree.Element("LTPage", page_index="0", height="800", width="600")
+    for n, line in enumerate(raw):
+        el = etree.SubElement(page, "LTTextLineHorizontal",
+                              x0="10", y0=str(700 - 20 * n), x1="500", y1=str(710 - 20 * n))
+        el.text = line
+    root = etree.Element("pdfxml")
+    root.append(page)
+    index = LayoutIndex(etree.ElementTree(root))
+    assert_equal(clippingparser.cleanup_for_match("\n".join(raw)), index.text)
+    assert_equal("are exclusive- i.e., they block transaction and softhyphen words - but not dashes",
+                 index.text)
+
+
+def test_layout_index_page_break():
+    from kindleparse.layoutindex import LayoutIndex
+    pdf.load(0, 17)
+    try:
+        index = LayoutIndex(pdf.pdf_query.tree)
+    finally:
+        pdf.load()
+    # pages 1 and 18 are not adjacent, so clips don't run across them
+    assert_equal(-1, index.text.find("want to read more? but what happens"))
+    lines = index.find("innovators want to read more? but what happens when two")
+    assert_equal(set([0]), set(l.page_index for l in lines))
+    lines = index.find("spreading the knowledge of innovators want to read more? " + "x" * 80)
+    assert_equal(set([0]), set(l.page_index for l in lines))
+
+
+def test_create_highlight_multiline():
+    from kindleparse import okularwriter
+    positions = pdf.get_clipping_positions(EXPECTED_CLIP_IN_PAGE[2][1])
+    assert_equal(1, len(positions))
+    page_index, points = positions[0]
+    assert_equal(17, page_index)
+    highlight_xml = okularwriter.create_highlight(points)
+    assert_equal(3, len(highlight_xml.findall('hl/quad')))
+    boundary = highlight_xml.find('base/boundary').attrib
+    assert_almost_equal(min(p[0] for p in points), float(boundary['l']))
+    assert_almost_equal(max(p[2] for p in points), float(boundary['r']))
+    assert_almost_equal(min(p[3] for p in points), float(boundary['t']))
+    assert_almost_equal(max(p[1] for p in points), float(boundary['b']))
+
+
+def test_load_batches():
+    from kindleparse.clippablepdf import current_rss
+    batch_pdf = ClippablePDF(book_file)
+    batches = list(batch_pdf.load_batches())
+    assert_equal([range(19)], batches)
+    # a budget lower than the current memory loads a page at a time
+    batches = list(batch_pdf.load_batches(range(2, 12), max_memory=current_rss() // 2))
+    assert_equal(range(2, 12), sum(batches, []))
+    assert_equal(range(2, 6), batches[0])
+    assert_equal([1] * 6, map(len, batches[1:]))
+
+
 def test_okular_sample_hl():
     from kindleparse.okularwriter import create_xml_file_hl
     destfile = mk_destfile(book_file)
-    create_xml_file_hl(destfile, EXPECTED_CLIP_IN_PAGE, pdf)
+    # a clip across a page break, and one not in the book
+    across = (b"Better yet, lock only the exact piece of data you plan to change. "
+              b"Minimizing the amount of data that you lock at any one time lets changes to")
+    missing = b"not in this book at all, really"
+    paged_clippings = EXPECTED_CLIP_IN_PAGE + [(18, across), (1, missing)]
+    report = create_xml_file_hl(destfile, paged_clippings, pdf)
+    assert_equal([p - 1 for p, _ in EXPECTED_CLIP_IN_PAGE] + [17],
+                 [p for p, _ in report.found])
+    assert_equal([(5, missing)], report.missed)
+    xml = parse(destfile)
+    assert_equal(['0', '17', '18'], [p.get('number') for p in xml.iter('page')])
+    # the two clips of the page and the first part of the one across the break
+    assert_equal(3, len(list(xml.find("pageList/page[@number='17']").iter('annotation'))))
 
 
 def test_okular_sample_hl2():
@@ -119,6 +677,65 @@ def test_okular_sample_hl2():
     create_xml_file_hl2(destfile, zip(*EXPECTED_CLIP_IN_PAGE)[1], pdf)
 
 
+def test_okular_sample_hl2_prefilter():
+    from kindleparse.okularwriter import create_xml_file_hl2, page_plan
+    clippings = list(zip(*EXPECTED_CLIP_IN_PAGE)[1])
+    plan = list(page_plan(pdf, clippings))
+    # the page after a clip is loaded too, as the clip may continue there
+    assert_equal([[0, 1, 17, 18]], plan)
+    plan = list(page_plan(pdf, clippings + [b'not in this book']))
+    assert_equal([[0, 1, 17, 18], range(2, 17)], plan)
+    loaded = []
+    load = pdf.load
+    pdf.load = lambda *pgs: loaded.append(pgs) or load(*pgs)
+    try:
+        destfile = mk_destfile(book_file)
+        create_xml_file_hl2(destfile, clippings, pdf)
+    finally:
+        del pdf.load
+        pdf.load()
+    assert_equal([(0, 1, 17, 18)], loaded)
+    xml = parse(destfile)
+    assert_equal(['0', '17', '18'], [p.get('number') for p in xml.iter('page')])
+
+
+def test_okular_sample_hl2_prefilter_page_break():
+    from kindleparse.okularwriter import create_xml_file_hl2
+    # the clip starts at the bottom of page 18 and ends on page 19
+    clip = (b"Better yet, lock only the exact piece of data you plan to change. "
+            b"Minimizing the amount of data that you lock at any one time lets changes to")
+    try:
+        destfile = mk_destfile(book_file)
+        report = create_xml_file_hl2(destfile, [clip], pdf)
+    finally:
+        pdf.load()
+    assert_equal([(17, clip)], report.found)
+    xml = parse(destfile)
+    assert_equal(['17', '18'], [p.get('number') for p in xml.iter('page')])
+
+
+def test_page_plan_after_predicted_pages():
+    from kindleparse.calibration import LocationModel
+    from kindleparse.okularwriter import page_plan
+    clips = [clippingparser.Clipping(amazon_title, text.encode(pdf_parser_codec),
+                                     'highlight', 10 * page)
+             for page, text in EXPECTED_CLIP_IN_PAGE]
+    model = LocationModel(pdf.num_pages, [(10, 0), (100, 9), (190, 18)])
+    remaining = list(clips)
+    plan = page_plan(pdf, lambda: remaining, model=model)
+    predicted = next(plan)
+    assert_true(set([0, 17, 18]) <= set(predicted))
+    # all the clips were placed in the predicted pages
+    del remaining[:]
+    assert_equal([], list(plan))
+    # only the clips still pending are searched in the text
+    remaining = list(clips)
+    plan = page_plan(pdf, lambda: remaining, model=model)
+    predicted = next(plan)
+    remaining[:] = [b'not in this book']
+    assert_equal([[p for p in range(pdf.num_pages) if p not in predicted]], list(plan))
+
+
 def test_is_clipping_position_in_page_1():
     for expected_pg, clip in EXPECTED_CLIP_IN_PAGE:
         page_index, coordinates = pdf.get_clipping_position(clip)
@@ -126,6 +743,7 @@ def test_is_clipping_position_in_page_1():
         yield assert_equal, str(page_index), str(expected_pg-1)
         yield assert_true, coordinates
 
+
 #
 # Create Okular xml files
 #
@@ -147,6 +765,219 @@ def test_create_fake_okular_xml_2():
     print(tostring(xml.getroot()))
 
 
+def test_document_writer_is_atomic():
+    from kindleparse.okularwriter import DocumentWriter, AnnotationIL
+    f = "fake3.xml"
+    with DocumentWriter(f) as writer:
+        writer.add(3, AnnotationIL())
+        writer.add(1, AnnotationIL())
+        writer.flush([3])
+        writer.add(3, AnnotationIL())
+    xml = parse(f)
+    assert_equal(['3', '1', '3'], [p.get('number') for p in xml.iter('page')])
+    assert_equal(f, xml.getroot().get('url'))
+    try:
+        with DocumentWriter(f) as writer:
+            writer.add(0, AnnotationIL())
+            raise ValueError()
+    except ValueError:
+        pass
+    # the previous file is still there
+    assert_equal(3, len(parse(f).findall('pageList/page')))
+    assert_equal([], [x for x in os.listdir('.') if x.endswith('.tmp')])
+
+
+def test_okular_sample_hl2_merge():
+    from copy import deepcopy
+    from kindleparse.okularwriter import create_xml_file_hl2, stable_name
+    destfile = "fake4.xml"
+    clippings = list(zip(*EXPECTED_CLIP_IN_PAGE)[1])
+    create_xml_file_hl2(destfile, clippings[:2], pdf)
+    # an annotation added by the user in okular
+    xml = parse(destfile)
+    user_annotation = deepcopy(xml.find('.//annotation'))
+    user_annotation.find('base').set('uniqueName', 'okular-{user}')
+    xml.find("pageList/page[@number='17']/annotationList").append(user_annotation)
+    xml.getroot().append(parse_xml_string('<generalInfo><history/></generalInfo>'))
+    xml.write(destfile)
+
+    searched = []
+    get_positions = pdf.get_clipping_positions
+    pdf.get_clipping_positions = lambda c: searched.append(c) or get_positions(c)
+    try:
+        create_xml_file_hl2(destfile, clippings, pdf, merge=True)
+    finally:
+        del pdf.get_clipping_positions
+    # only new clippings are searched
+    assert_equal(clippings[2:], searched)
+    xml = parse(destfile)
+    names = [b.get('uniqueName') for b in xml.iter('base')]
+    assert_equal(5, len(names))
+    assert_in('okular-{user}', names)
+    assert_equal(set(stable_name(c) for c in clippings), set(names) - set(['okular-{user}']))
+    assert_equal(3, len(xml.findall("pageList/page")))
+    assert_equal(3, len(xml.findall("pageList/page[@number='17']/annotationList/annotation")))
+    assert_true(xml.find('generalInfo/history') is not None)
+
+
+def test_okular_sample_hl2_merge_duplicate_texts():
+    from kindleparse.okularwriter import create_xml_file_hl2, stable_name
+    destfile = "fake5.xml"
+    text = EXPECTED_CLIP_IN_PAGE[3][1].encode(pdf_parser_codec)
+    # the same text highlighted twice, at different locations
+    first = clippingparser.Clipping(amazon_title, text, 'highlight', 46, 47)
+    second = clippingparser.Clipping(amazon_title, text, 'highlight', 48, 49)
+    assert_true(stable_name(first) != stable_name(second))
+    assert_equal(stable_name(first), stable_name(
+        clippingparser.Clipping(amazon_title, text, 'highlight', 46, 47)))
+    create_xml_file_hl2(destfile, [first], pdf)
+    report = create_xml_file_hl2(destfile, [first, second], pdf, merge=True)
+    assert_equal([(18, second)], report.found)
+    names = [b.get('uniqueName') for b in parse(destfile).iter('base')]
+    assert_equal(sorted([stable_name(first), stable_name(second)]), sorted(names))
+
+
+def test_batch_process_library():
+    from kindleparse import batch
+    with temp_dir() as library:
+        manifest = os.path.join(library, "books.txt")
+        with open(manifest, 'wb') as fh:
+            fh.write(b"# my books\n%s\nmissing.pdf\n" % os.path.abspath(book_file))
+        books = batch.find_books([manifest, library.encode('utf-8')])
+        assert_equal([os.path.abspath(book_file), os.path.join(library, b"missing.pdf")], books)
+        clippings = clippingparser.parse_clipping_records(clippings_file)
+        # the same book listed twice is processed once
+        summaries = batch.process_library(books + [book_file], clippings, jobs=2,
+                                          overwrite=True)
+        assert_equal(books, [s.pdf_file for s in summaries])
+        assert_equal(amazon_title, summaries[0].title)
+        assert_equal((5, 0, None), summaries[0][2:4] + (summaries[0].error, ))
+        assert_in("IOError", summaries[1].error)
+
+
+def test_watch_library():
+    from kindleparse import watch
+    with open(clippings_file, 'rb') as fh:
+        data = fh.read()
+    split = data.index(b"JBoss")
+    with temp_dir() as library:
+        clips = os.path.join(library, b"My Clippings.txt")
+        book = os.path.join(library, b"watched.pdf")
+        shutil.copy(book_file, book)
+        destfile = mk_destfile(book)
+        try:
+            with open(clips, 'wb') as fh:
+                fh.write(data[split:])
+            watcher = watch.LibraryWatcher(clips, [library], cache_dir=None)
+            # files are read once they stop changing
+            assert_equal([], watcher.poll())
+            summaries = watcher.poll()
+            assert_equal([book], [s.pdf_file for s in summaries])
+            assert_in("Clippings not found", summaries[0].error)
+            assert_equal([], watcher.poll())
+            # the Kindle appends the clippings of the book
+            with open(clips, 'ab') as fh:
+                fh.write(data[:split])
+            assert_equal([], watcher.poll())
+            summaries = watcher.poll()
+            assert_equal(amazon_title, summaries[0].title)
+            assert_equal((5, 0, None), summaries[0][2:4] + (summaries[0].error, ))
+            # clippings of other books don't touch it
+            with open(clips, 'ab') as fh:
+                fh.write(data[split:])
+            watcher.poll()
+            assert_equal([], watcher.poll())
+            assert_equal(2, len(watcher.feed.records["Altai (Wu Ming)"]))
+        finally:
+            if os.path.isfile(destfile):
+                os.unlink(destfile)
+
+
+def test_clippings_feed_rewrite():
+    from kindleparse import watch
+    with open(clippings_file, 'rb') as fh:
+        data = fh.read()
+    # longer than HEAD_SIZE, so that the end is not in the head
+    data = data * 4
+    fd, clips = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        with open(clips, 'wb') as fh:
+            fh.write(data)
+        feed = watch.ClippingsFeed(clips)
+        feed.update()
+        assert_equal(4, len(feed.records["Altai (Wu Ming)"]))
+        # an entry after the head is edited in place
+        pos = data.rindex(b"Altai")
+        with open(clips, 'wb') as fh:
+            fh.write(data[:pos] + b"Alpha" + data[pos + 5:] + data[:10])
+        assert_in("Alpha (Wu Ming)", feed.update())
+        assert_equal(3, len(feed.records["Altai (Wu Ming)"]))
+        # a file that can't be read empties the feed
+        os.unlink(clips)
+        assert_raises(OSError, feed.update)
+        assert_equal(({}, 0), (feed.records, feed.offset))
+        # and doesn't stop the watcher
+        watcher = watch.LibraryWatcher(tempfile.gettempdir(), [], cache_dir=None)
+        assert_equal([], watcher.changes())
+        assert_equal([], watcher.changes())
+    finally:
+        if os.path.isfile(clips):
+            os.unlink(clips)
+
+
+def test_import_is_lazy():
+    import subprocess
+    import sys
+    heavy = subprocess.check_output([sys.executable, "-c", (
+        "import sys, kindleparse; "
+        "print(sorted(m for m in sys.modules if m.split('.')[0] in "
+        "('pdfminer', 'pdfquery', 'pyPdf', 'lxml')))")])
+    assert_equal(b"[]", heavy.strip())
+
+
+def test_profiling_stages():
+    from kindleparse import profiling
+    profiling.reset()
+    with profiling.stage("disabled"):
+        profiling.count("disabled")
+    assert_equal({}, profiling.to_dict()['stages'])
+    profiling.enable()
+    try:
+        clippings = clippingparser.parse_clipping_records(clippings_file)
+        clippingparser.match_clippings_in_text(clippings[amazon_title], ["a page"])
+        profiling.count("pages", 2)
+        profiling.count("pages")
+        data = profiling.to_dict()
+    finally:
+        profiling.disable()
+        profiling.reset()
+    assert_equal(["parse_clippings", "match_text"], list(data['stages']))
+    assert_equal(1, data['stages']['match_text']['calls'])
+    assert_equal({"pages": 3}, dict(data['counters']))
+
+
+def test_profiling_samples_rss():
+    from kindleparse import profiling
+    samples = []
+    rss = profiling.current_rss
+    profiling.current_rss = lambda: samples.append(1) or rss()
+    profiling.enable()
+    try:
+        for _ in range(1000):
+            with profiling.stage("short"):
+                pass
+        data = profiling.to_dict()
+    finally:
+        profiling.current_rss = rss
+        profiling.disable()
+        profiling.reset()
+    assert_equal(1000, data['stages']['short']['calls'])
+    # short stages read the rss at most every RSS_INTERVAL
+    assert_true(1 <= len(samples) < 10)
+    assert_true(data['stages']['short']['max_rss'] > 0)
+
+
 def test_create_sample_okular_xml():
     destfile = mk_destfile(book_file)
     clippings = clippingparser.parse_clippings(clippings_file)